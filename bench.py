@@ -0,0 +1,235 @@
+#! /usr/bin/python
+
+"""Usage: bench.py [OPTS] [SCRIPT...]
+Times the bundled prosegrams, checks their output, and compares the
+timings against a recorded baseline. Also measures the memory taken by
+each item in a long run, how quickly the bundled scripts are parsed, and
+how long colossal.py takes to start.
+
+OPTS:
+  -b FILENAME  Baseline to compare against or record [default bench.json]
+  -r           Record this run as the new baseline
+  -n COUNT     Run each case COUNT times and keep the fastest [default 3]
+  -t FRACTION  Flag anything this much slower, or items this much bigger,
+               than the baseline [default 0.25]
+  -h           Print this stuff, right here.
+
+If SCRIPT arguments are given, only cases for those scripts are run.
+Exits with status 1 if any output is wrong or any case has regressed.
+"""
+
+import sys, os, getopt, json, time, fractions, math
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SLACK = 0.05  # Seconds of noise to allow before calling anything a regression
+ITEMS = 100000  # Items to make when measuring the memory each one takes
+LINES = 100  # Times to parse the bundled scripts when timing the parser
+STARTS = 10  # Times to start colossal.py when timing how long that takes
+
+
+def counting(n):
+  return ''.join(['%d\n' % i for i in range(1, n+1)])
+
+# Each case: a script, its parameters, and what it should print
+CASES = [('hello.adv', [], 'Hello, World!\n')]
+for n in 10, 100, 1000, 5000:
+  CASES.append(('count.adv', [str(n)], counting(n)))
+for a,b in (12, 18), (91, 35), (1000, 7), (2000, 3):
+  CASES.append(('gcd.adv', [str(a), str(b)], '%d\n' % fractions.gcd(a, b)))
+for a,b in (3, 4), (12, 12):
+  CASES.append(('times.adv', [str(a), str(b)], '%d\n' % (a * b)))
+for n in 4, 6:
+  CASES.append(('fact.adv', [str(n)], '%d\n' % math.factorial(n)))
+for n in 3, 100:
+  CASES.append(('twice.adv', [str(n)], '%d\n%d\n' % (n, n)))
+
+
+def name(script, params):
+  return ' '.join([script] + params)
+
+
+def run(script, params):
+  # Run one case in its own interpreter; returns its output and statistics
+  r, w = os.pipe()
+  start = time.time()
+  pid = os.fork()
+  if not pid:
+    os.dup2(w, 2)
+    out = os.open(os.path.join(HERE, 'bench_output.txt'),
+                  os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(out, 1)
+    os.chdir(HERE)
+    os.execv(sys.executable, [sys.executable, 'colossal.py', '-s',
+                              '-f', script] + params)
+  os.close(w)
+  err = os.fdopen(r).read()
+  _, status, usage = os.wait4(pid, 0)
+  wall = time.time() - start
+  output = open(os.path.join(HERE, 'bench_output.txt')).read()
+  stats = {}
+  if err.strip():
+    try:
+      stats = json.loads(err.strip().split('\n')[-1])
+    except ValueError:
+      pass
+  stats.update(wall=wall, rss=usage.ru_maxrss, status=status)
+  return output, stats
+
+
+def inside(measure, *args):
+  # What measure(colossal, *args) returns when called in a fresh
+  # interpreter that's just imported colossal
+  r, w = os.pipe()
+  pid = os.fork()
+  if not pid:
+    os.close(r)
+    sys.path.insert(0, HERE)
+    os.chdir(HERE)
+    try:
+      import colossal
+      os.write(w, json.dumps(measure(colossal, *args)))
+    except:
+      import traceback
+      traceback.print_exc()
+    os._exit(0)
+  os.close(w)
+  result = json.loads(os.fdopen(r).read())
+  os.waitpid(pid, 0)
+  return result
+
+
+def weigh(colossal, count):
+  # Bytes per item, from how much the interpreter grows making count
+  # metering labels in a box, each with a line of writing on it, the way
+  # count.adv does
+  import resource
+  box = colossal.Item('cardboard box', None, capacity=float('inf'))
+  before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  for i in xrange(count):
+    label = colossal.Item('metering label', box)
+    label.write(str(i))
+    label.name = str(i)
+  after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return (after - before) * 1024.0 / count
+
+
+def parse(colossal, repeat):
+  # Lines of the bundled scripts split into words, and parsed into
+  # commands ready to perform, per second. Prose after a script's quit,
+  # which isn't meant to be parsed, is left out.
+  import glob, shlex
+  lines = []
+  for script in sorted(glob.glob('*.adv')):
+    for line in open(script):
+      if line.strip():
+        try:
+          shlex.split(line)
+        except ValueError:
+          continue
+        lines.append(line)
+  split = getattr(colossal, 'split', shlex.split)
+  rates = {}
+  start = time.time()
+  for i in xrange(repeat):
+    for line in lines:
+      split(line)
+  rates['split/s'] = repeat * len(lines) / (time.time() - start)
+  start = time.time()
+  for i in xrange(repeat):
+    for line in lines:
+      colossal.Command(line).prepare()
+  rates['parsed/s'] = repeat * len(lines) / (time.time() - start)
+  return rates
+
+
+def startup(count):
+  # Milliseconds from starting colossal.py to its being ready to follow a
+  # script's first command, the fastest of count tries with an empty one
+  return min([run(os.devnull, [])[1]['wall'] for i in range(count)]) * 1000
+
+
+def main():
+  opts,args = getopt.getopt(sys.argv[1:], 'b:rn:t:h')
+  BASELINE = os.path.join(HERE, 'bench.json')
+  RECORD = False
+  REPEAT = 3
+  TOLERANCE = 0.25
+  for o,a in opts:
+    if o == '-b':
+      BASELINE = a
+    elif o == '-r':
+      RECORD = True
+    elif o == '-n':
+      REPEAT = int(a)
+    elif o == '-t':
+      TOLERANCE = float(a)
+    else:
+      sys.stderr.write(__doc__)
+      sys.exit()
+
+  baseline = {}
+  if os.path.exists(BASELINE):
+    baseline = json.load(open(BASELINE))
+
+  results = {}
+  failed = False
+  print '%-24s %9s %11s %8s %6s %7s  %s' % (
+    'case', 'wall s', 'commands/s', 'rss KB', 'depth', 'items', 'vs baseline')
+  for script, params, expected in CASES:
+    if args and script not in args:
+      continue
+    case = name(script, params)
+    best = None
+    for i in range(REPEAT):
+      output, stats = run(script, params)
+      if not best or stats['wall'] < best['wall']:
+        best = stats
+    best['commands/s'] = int(best.get('commands', 0) / best['wall'])
+    results[case] = best
+
+    notes = []
+    if output != expected or best['status']:
+      notes.append('WRONG OUTPUT')
+      failed = True
+    if case in baseline:
+      ratio = best['wall'] / baseline[case]['wall']
+      notes.append('%+.0f%%' % ((ratio - 1) * 100))
+      if (ratio > 1 + TOLERANCE and
+          best['wall'] - baseline[case]['wall'] > SLACK):
+        notes.append('REGRESSION')
+        failed = True
+    print '%-24s %9.3f %11d %8d %6d %7d  %s' % (
+      case, best['wall'], best['commands/s'], best['rss'],
+      best.get('depth', 0), best.get('items', 0), ' '.join(notes))
+
+  if not args:
+    print
+    results['bytes/item'] = inside(weigh, ITEMS)
+    rates = max([inside(parse, LINES) for i in range(REPEAT)],
+                key=lambda rates: rates['parsed/s'])
+    results.update(rates)
+    results['startup ms'] = startup(STARTS)
+    for key, label, worse in (('bytes/item', 'bytes per item', 1),
+                              ('split/s', 'lines split per second', -1),
+                              ('parsed/s', 'lines parsed per second', -1),
+                              ('startup ms', 'ms to first command', 1)):
+      notes = []
+      if key in baseline:
+        ratio = results[key] / baseline[key]
+        notes.append('%+.0f%%' % ((ratio - 1) * 100))
+        if (ratio - 1) * worse > TOLERANCE:
+          notes.append('REGRESSION')
+          failed = True
+      print '%11d %-24s %s' % (results[key], label, ' '.join(notes))
+
+  if os.path.exists(os.path.join(HERE, 'bench_output.txt')):
+    os.remove(os.path.join(HERE, 'bench_output.txt'))
+
+  if RECORD:
+    baseline.update(results)
+    json.dump(baseline, open(BASELINE, 'w'), indent=1, sort_keys=True,
+              separators=(',', ': '))
+  sys.exit(1 if failed and not RECORD else 0)
+
+if __name__ == '__main__':
+  main()
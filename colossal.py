@@ -5,27 +5,133 @@ Runs Colossal, the text adventure that's also a programming language.
 
 OPTS:
   -f FILENAME  Perform the steps specified in the file FILENAME
-  -v           Print feedback to stderr [default only in interactive mode]
+  -v           Print feedback to stderr, buffered like output (see -B and
+               -I) [default only in interactive mode]
   -V           Print feedback to stdout
   -q           Do not output feedback [default in noninteractive mode]
+  -d DEPTH     Follow orders nested at most DEPTH deep [default 10000]
+  -s           Print statistics about the run to stderr, as JSON, when done
+  -P           Print a profile of time spent by line to stderr when done
+  -F FILENAME  Write the profile to FILENAME as collapsed stacks, for
+               flame graphs
+  -b FILENAME  Run the batch of jobs in FILENAME ("-" for stdin), writing
+               their results to stdout
+  -j COUNT     Run batch jobs COUNT at a time [default the number of CPUs]
+  -t SECONDS   Give up on a batch job after SECONDS [default never]
+  -u           Write batch results as they finish, not in the jobs' order
+  -o FD        Write output to the file descriptor FD [default 1, stdout]
+  -B BYTES     Buffer up to BYTES of output at a time [default 65536]
+  -I SECONDS   Write out buffered output at least every SECONDS, if there's
+               more to write [default only when the buffer's full]
+  -r           Output pages as their lines run together, without newlines
+               between or after them
+  -p           Start fetching a file as soon as its name's written on the
+               roof, rather than waiting for the pidgeon to be sent
+  -S ADDRESS   Serve a world apiece to players connecting to ADDRESS,
+               either HOST:PORT or the path of a Unix socket
+  -T FILENAME  Trace the run to FILENAME: every command followed and every
+               change it makes to the world
+  -R FILENAME  Rather than starting afresh, carry on from the world as it
+               was at the end of the run traced to FILENAME, outputting
+               again what it output since its last checkpoint
+  -n STEP      Replay the trace only as far as STEP commands into the run
+  -c FILENAME  Checkpoint the run to FILENAME every so often: the world,
+               the orders being followed and how far into the input it's got
+  -e EVERY     Checkpoint every EVERY commands, or with an s after it, every
+               EVERY seconds (default 60s); may be given twice, for both
+  --resume     Carry on from the checkpoint in FILENAME, if there is one,
+               rather than starting afresh. Output to a file is cut back to
+               where it was at the checkpoint, so append to it (>>).
   -h           Print this stuff, right here.
 
 If no filename arguments are specified, run an interactive session.
 
+BATCHES:
+
+Each line of a batch is a job, a JSON object with the "script" to run
+and its "params", e.g. {"script": "gcd.adv", "params": ["12", "18"]}.
+Each job is run in a pristine world, and its result written as a line of
+JSON: the job, its number, what it printed, its exit status (124 if it
+timed out), any error, how many commands it ran and how long it took.
+
 PARAMETERS:
 
 Any further parameters passed on the command line appear within the
 adventure somewhere. I won't spoil it by telling you where.
 """
 
-import sys, random, getopt, textwrap, shlex, fileinput, math
+import sys, os, random, getopt, fileinput, math, time, re, cPickle
+import cStringIO, signal, itertools, threading, collections, socket
+import asyncore, mmap, struct, stat, marshal
+
 
+class Rooms(dict):
+  # Mapping from room names to rooms, where a floor of the staircase that's
+  # not there is made as it's needed
+  def __missing__(self, name):
+    room = stairs(name)
+    if not room:
+      raise KeyError(name)
+    return room
 
-ROOMS = { }  # Mapping from room names to rooms
+ROOMS = Rooms()
 DIRECTIONS = set()  # All possible directions one might go
 NOUNS = set()
 ADJECTIVES = set()
 NAMES = set()
+PARSED = set()  # Words appearing in cached commands
+EPOCH = 0  # Bumped whenever the vocabulary changes under a cached command
+SPEECHES = {}  # Lines and procedure for each thing a robot's been told
+CACHED = 1000  # Lines a procedure keeps parsed, and speeches a robot keeps
+WORDS = 10000  # Words in PARSED at which it's forgotten, and EPOCH bumped
+
+# What an item's description can make of each word, as bits
+THE, SELECTOR, ADJECTIVE, NOUN, CALLED, NAME = [1 << i for i in range(6)]
+KINDS = { 'the': THE, 'called': CALLED,
+          'all': SELECTOR, 'first': SELECTOR, 'last': SELECTOR }
+
+def learn(vocabulary, word):
+  global EPOCH
+  if word not in vocabulary:
+    vocabulary.add(word)
+    kind = (vocabulary is NOUNS and NOUN or
+            vocabulary is ADJECTIVES and ADJECTIVE or
+            vocabulary is NAMES and NAME)
+    if kind:
+      KINDS[word] = KINDS.get(word, 0) | kind
+    if word.lower() in PARSED:
+      EPOCH += 1
+
+# Vessels watching for changes to their state, and the changes seen during
+# the command being performed, to pass on once it's done
+CHANGED = []  # (vessel, events) pairs, in the order the vessels changed
+
+def changed(vessel, event):
+  # Few vessels watch, so a list is looked through quicker than an ordered
+  # dict is kept
+  if event in vessel.WATCH:
+    for seen, events in CHANGED:
+      if seen is vessel:
+        events.add(event)
+        return
+    CHANGED.append((vessel, set([event])))
+
+def settle():
+  while CHANGED:
+    vessel, events = CHANGED.pop(0)
+    vessel.onChange(events)
+
+MAX_DEPTH = 10000  # How deeply orders may be nested within orders
+HOT = 50  # How many times orders are obeyed before they're compiled
+TURN = 100  # How many commands each entity follows before the next's turn
+BUSY = collections.deque()  # Entities with orders to follow, in turn
+TRACE = None  # Where commands and their changes to the world are recorded
+CHECKPOINT = None  # Where the run is saved every so often, to resume it
+STATS = { 'commands': 0,  # Lines executed
+          'depth': 0,  # Deepest nesting of orders
+          'items': 0 }  # Items created
+
+class ColossalError(Exception): pass
 
 TYPES = {
   'page': 'parchment',
@@ -33,9 +139,169 @@ TYPES = {
   'letter': 'parchment'
   }
 
+class Contents(object):
+  # The items in a vessel, in order, and indexed by noun, adjective, name
+  # and type. An item removed leaves a hole in its slot; holes are swept
+  # out once they outnumber the items.
+  __slots__ = ('slots', 'where', 'head', 'index', 'fixtures')
+
+  def __init__(self):
+    self.slots = []
+    self.where = {}  # Mapping from item to its slot
+    self.head = 0  # Slots before this one are all holes
+    self.index = {}  # Mapping from (attribute, value) to a set of items
+    self.fixtures = []  # Fixed and mobile items, in order
+
+  def __len__(self):
+    return len(self.where)
+
+  def __contains__(self, item):
+    return item in self.where
+
+  def __iter__(self):
+    where = self.where
+    for item in self.slots[self.head:]:
+      if item is not None and item in where:
+        yield item
+
+  def __getitem__(self, i):
+    if not self.where:
+      raise IndexError('no items')
+    if i == 0:
+      return self.slots[self.head]
+    elif i == -1:
+      return self.slots[-1]
+    self.sweep()
+    return self.slots[i]
+
+  def keys(self, item):
+    return (('noun', item.noun), ('adjective', item.adjective),
+            ('name', item.name), ('type', item.type))
+
+  def append(self, item):
+    self.where[item] = len(self.slots)
+    self.slots.append(item)
+    for key in self.keys(item):
+      self.index.setdefault(key, set()).add(item)
+    if item.fixed or item.mobile:
+      self.fixtures.append(item)
+
+  def remove(self, item):
+    if item not in self.where:
+      raise ValueError('Contents.remove(x): x not in contents')
+    slots = self.slots
+    slots[self.where.pop(item)] = None
+    for key in self.keys(item):
+      self.unindex(item, key)
+    if item.fixed or item.mobile:
+      self.fixtures.remove(item)
+    while slots and slots[-1] is None:
+      slots.pop()
+    while self.head < len(slots) and slots[self.head] is None:
+      self.head += 1
+    if not slots:
+      self.head = 0
+    elif len(slots) > 2 * len(self.where) + 8:
+      self.sweep()
+
+  def unindex(self, item, key):
+    bucket = self.index[key]
+    bucket.discard(item)
+    if not bucket:
+      del self.index[key]
+
+  def rename(self, item, old, new):
+    if item in self.where:
+      self.unindex(item, ('name', old))
+      self.index.setdefault(('name', new), set()).add(item)
+
+  def sweep(self):
+    self.slots = [item for item in self.slots if item is not None]
+    self.where = dict([(item, i) for (i, item) in enumerate(self.slots)])
+    self.head = 0
+
+  def reverse(self):
+    self.sweep()
+    self.slots.reverse()
+    self.where = dict([(item, i) for (i, item) in enumerate(self.slots)])
+    self.fixtures.reverse()
+
+  def having(self, attribute, value):
+    return self.ordered(self.index.get((attribute, value), ()))
+
+  def ordered(self, items):
+    items = list(items)
+    if len(items) > 1:
+      items.sort(key=self.where.get)
+    return items
+
+  def loose(self):
+    return [i for i in self if not (i.fixed or i.mobile)]
+
+  def first(self):
+    slots = self.slots
+    for i in xrange(self.head, len(slots)):
+      item = slots[i]
+      if item is not None and not (item.fixed or item.mobile):
+        return [item]
+    return []
+
+  def last(self):
+    for item in reversed(self.slots):
+      if item is not None and not (item.fixed or item.mobile):
+        return [item]
+    return []
+
+  def match(self, spec):
+    buckets = [self.index.get((a, getattr(spec, a)), ())
+               for a in ('adjective', 'noun', 'name') if getattr(spec, a)]
+    if not buckets:
+      return []
+    smallest = min(buckets, key=len)
+    return self.ordered([o for o in smallest if o.match(spec)])
+
+  def __reduce_ex__(self, protocol):
+    # The shared empty contents stay shared when the world's unpickled
+    if self is EMPTY:
+      return 'EMPTY'
+    return object.__reduce_ex__(self, protocol)
+
+EMPTY = Contents()  # The contents of every vessel that's never held a thing
+
+SLOTS = {}
+
+def slots(cls):
+  # The names of all the slots of a cls instance
+  if cls not in SLOTS:
+    SLOTS[cls] = [name for c in cls.__mro__
+                  for name in c.__dict__.get('__slots__', ())]
+  return SLOTS[cls]
+
+def slotted(thing):
+  # The slots thing has values for, and their values
+  return dict([(name, getattr(thing, name)) for name in slots(type(thing))
+               if hasattr(thing, name)])
+
+def alter(thing, attribute, value):
+  # Sets an attribute that's not otherwise watched, so it's traced
+  setattr(thing, attribute, value)
+  if TRACE:
+    TRACE.change(Trace.SET, thing, (attribute, value))
+
+
 class Vessel(object):
+  __slots__ = ('items', 'load', 'fraction', 'capacity', 'closed', 'locked',
+               'location')
+  # Changes this kind of vessel is told of by onChange() after the command
+  # that made them: 'contents' when things are put in or taken out, 'weight'
+  # when what's inside gets heavier or lighter, 'closed' when it's opened or
+  # closed
+  WATCH = ()
+
   def __init__(self, capacity=0, closed=None, locked=None):
-    self.items = []
+    self.items = EMPTY
+    self.load = 0  # Total weight of everything inside, in whole kg
+    self.fraction = 0  # And the rest of it
     self.capacity = capacity or 0
     self.closed = closed
     self.locked = locked
@@ -45,15 +311,14 @@ class Vessel(object):
     if not spec:
       return []
     if spec.selector:
-      pool = [i for i in self.items if not (i.fixed or i.mobile)]
       if spec.selector == 'all':
-        return pool
+        return self.items.loose()
       elif spec.selector == 'first':
-        return pool[:1]
+        return self.items.first()
       elif spec.selector == 'last':
-        return pool[-1:]
+        return self.items.last()
     else:
-      return [o for o in self.items if o.match(spec)]
+      return self.items.match(spec)
 
   def move(self, dest, *message):
     container = dest
@@ -78,27 +343,95 @@ class Vessel(object):
     if dest and dest.closed and source:
       say('The', dest, 'is closed.')
       return False
-    if dest and self.qty and self.type in [i.type for i in dest.items]:
-      others = [i for i in dest.items if i.type == self.type]
+    others = dest and self.qty and dest.items.having('type', self.type)
+    if others:
       others[0].qty += self.qty
-    elif dest:
-      if len(dest.items) >= dest.capacity:
-        say('No more room!')
-        return False
-      dest.items.append(self)
-    if self.location:
-      self.location.items.remove(self)
-    self.location = dest
+    elif dest and len(dest.items) >= dest.capacity:
+      say('No more room!')
+      return False
+    self.place(dest, bool(dest and not others))
     if message:
       say(*message)
     if dest:
+      if 'contents' in dest.WATCH:
+        changed(dest, 'contents')
       self.onArrive()
       dest.onTake(self, source)
+    if source:
+      if 'contents' in source.WATCH:
+        changed(source, 'contents')
+      source.onLeave(self)
     return True
 
+  def place(self, dest, inside):
+    # Puts this vessel in dest, no questions asked. It's only among dest's
+    # items if inside, and not if it's been added to something there.
+    if inside:
+      if dest.items is EMPTY:
+        dest.items = Contents()
+      dest.items.append(self)
+    source = self.location
+    weight = (self.qty or 0) + self.load
+    if source:
+      if type(weight) is float and infinite(weight):
+        source.items.remove(self)
+        source.reweigh()
+      else:
+        self.carry(-weight, self.fraction, -1)
+        source.items.remove(self)
+    self.location = dest
+    if dest:
+      self.carry(weight, self.fraction)
+    if TRACE:
+      TRACE.move(self, dest, inside)
+
+  def carry(self, weight, fraction=0, sign=1):
+    # Pass a change in this vessel's weight up to the vessels around it: the
+    # weight, and the fraction times sign. Whole kilograms are added up as
+    # ints, and any Fraction kept apart so as not to make every sum a
+    # Fraction.
+    if type(weight) is not int:
+      if type(weight) is float and infinite(weight):
+        if self.location and self in self.location.items:
+          self.location.reweigh()
+        return
+      if type(weight) not in PLAIN:
+        weight, fraction, sign = 0, exact(weight + sign * fraction), 1
+    vessel = self
+    while vessel.location and vessel in vessel.location.items:
+      vessel = vessel.location
+      vessel.load += weight
+      if fraction:
+        vessel.fraction = plus(vessel.fraction, fraction, sign)
+      if 'weight' in vessel.WATCH:
+        changed(vessel, 'weight')
+
+  def reweigh(self):
+    # Weigh what's in this vessel, and the vessels around it, afresh. Once
+    # an infinite weight comes or goes, the running totals can't be trusted:
+    # inf - inf is nan.
+    vessel = self
+    while True:
+      load = fraction = 0
+      for item in vessel.items:
+        qty = item.qty or 0
+        if type(qty) in PLAIN:
+          load += qty
+        else:
+          fraction += qty
+        load += item.load
+        fraction += item.fraction
+      vessel.load, vessel.fraction = load, exact(fraction)
+      if 'weight' in vessel.WATCH:
+        changed(vessel, 'weight')
+      if not (vessel.location and vessel in vessel.location.items):
+        break
+      vessel = vessel.location
+
   def onTake(self, item, source): pass
+  def onLeave(self, item): pass
   def onArrive(self): pass
-  def onClose(self): pass
+  def onChange(self, events): pass
   def onHear(self, speech, source): say('It seems not to hear.')
   def onPush(self): say("That doesn't appear to do anything.")
   def onRub(self): say("That doesn't do much. Maybe its a little shinier?")
@@ -106,13 +439,15 @@ class Vessel(object):
   
 
 class Room(Vessel):
+  __slots__ = ('name', 'description', 'exits', 'resources')
+
   def __init__(self, name, description, exits, resources=None):
     Vessel.__init__(self, capacity=float('inf'))
     self.name = name
     self.description = description
     self.exits = dict([(n,ROOMS.get(n,x)) for (n,x) in exits.items()])
-    global DIRECTIONS
-    DIRECTIONS |= set(exits.keys())
+    for direction in exits:
+      learn(DIRECTIONS, direction)
     self.resources = resources or {}
     ROOMS[name] = self
 
@@ -120,9 +455,11 @@ class Room(Vessel):
     return self.name
 
   def find(self, q):
-    return Vessel.find(self, q) or sum([i.find(q)
-                                        for i in self.items
-                                        if i.fixed or i.mobile], [])
+    found = Vessel.find(self, q)
+    if not found:
+      for i in self.items.fixtures:
+        found.extend(i.find(q))
+    return found
 
   def describe(self, brief=False):
     if brief:
@@ -134,8 +471,6 @@ class Room(Vessel):
         if item.type != 'You' and not item.fixed:
           result += '\n\nThere is ' + item.describe(True) + ' here.'
     return result
-
-  def onTick(self): pass
           
 
 ORDINARY = [
@@ -152,29 +487,101 @@ INSCRIBED = [
 
 MASS_NOUNS = ['dirt'];
 
+# Quantities are exact: ints, however big they get, or Fractions where a
+# capacity makes them so. The fractions module is only imported once one's
+# needed.
+PLAIN = (int, long, float, type(None))  # Quantities that aren't Fractions
+
+def exact(q):
+  if type(q) not in PLAIN and q.denominator == 1:
+    return q.numerator
+  return q
+
+def plus(a, b, sign=1):
+  # a + b, or a - b if sign is -1, for the fractions of a kilogram vessels
+  # keep: mostly 0, or the same Fraction coming and going again. Those that
+  # share a denominator are added as ints, which is much quicker than
+  # Fraction's own arithmetic.
+  if not b:
+    return a
+  if not a and sign > 0:
+    return b
+  if a.denominator == b.denominator:
+    n = a.numerator + sign * b.numerator
+    if n % a.denominator == 0:
+      return n // a.denominator
+  return exact(a + b if sign > 0 else a - b)
+
+def infinite(q):
+  # Whether q is a float too big, or too strange, to be added and taken
+  # away again
+  return type(q) is float and (math.isinf(q) or math.isnan(q))
+
+def quantity(text):
+  # The quantity text says; floats only for inf and nan
+  try:
+    return int(text)
+  except ValueError:
+    pass
+  import fractions
+  try:
+    return exact(fractions.Fraction(text))
+  except ValueError:
+    return float(text)
+
+POWERS = { 1000: 10 ** 1000 }  # Powers of ten, by exponent, for writing
+                               # out big numbers
+
+def decimal(n, digits=None):
+  # The decimal digits of n, zero-padded to digits if given. Big numbers are
+  # split in half around a power of ten and each half written out, which
+  # is quicker than str() on hundreds of thousands of digits.
+  if n < POWERS[1000]:
+    return str(n).zfill(digits) if digits else str(n)
+  k = 1000
+  while True:
+    power = POWERS.get(k) or POWERS.setdefault(k, 10 ** k)
+    if power * power > n:
+      break
+    k *= 2
+  high, low = divmod(n, power)
+  return decimal(high, digits and digits - k) + decimal(low, k)
+
+def amount(q):
+  # q written out: whole numbers exactly, anything else as a float would be
+  q = exact(q)
+  if isinstance(q, (int, long)):
+    return ('-' + decimal(-q)) if q < 0 else decimal(q)
+  return str(float(q))
+
 
 class Item(Vessel):
+  __slots__ = ('adjective', 'noun', 'type', '_name', '_writing', 'description',
+               '_qty', 'orders')
+
   def __init__(self, phrase, location, description=None,
                capacity=0, closed=None, locked=None, qty=None):
     Vessel.__init__(self, capacity=capacity, closed=closed, locked=locked)
+    STATS['items'] += 1
     if len(phrase.split(' ')) > 1:
-      self.adjective, self.noun = phrase.split(' ')
+      self.adjective, self.noun = map(intern, phrase.split(' '))
     else:
-      self.noun = phrase
+      self.noun = intern(phrase)
       self.adjective = None
     self.type = TYPES.get(self.noun, self.noun)
-    global ADJECTIVES
-    NOUNS.add(self.noun.lower())
+    learn(NOUNS, self.noun.lower())
     if self.adjective:
-      ADJECTIVES.add(self.adjective.lower())
+      learn(ADJECTIVES, self.adjective.lower())
     self._name = None
-    self.fixed = False
-    self.mobile = False
-    self.writing = []
+    self._writing = ()
+    self.orders = None
     self.description = description
-    self.qty = qty
+    self._qty = qty
     if location: self.move(location)
 
+  fixed = False  # Fixed in place, like furniture
+  mobile = False  # Moves itself about
+
   def __str__(self):
     result = (self.adjective + ' ' if self.adjective else '') + self.noun
     if self.name:
@@ -184,7 +591,7 @@ class Item(Vessel):
   def describe(self, brief=False):
     mass = self.type in MASS_NOUNS
     if self.qty:
-      an = str(self.qty) + ' kg of'
+      an = amount(self.qty) + ' kg of'
     else:
       an = 'some' if mass else 'an' if str(self)[0] in 'aeiou' else 'a'
     if brief:
@@ -209,11 +616,62 @@ class Item(Vessel):
   @name.setter
   def name(self, name):
     if name:
-      NAMES.add(name.lower())
+      learn(NAMES, name.lower())
+    if self.location:
+      self.location.items.rename(self, self._name, name)
     self._name = name
+    if TRACE:
+      TRACE.change(Trace.NAME, self, name)
+
+  @property
+  def qty(self):
+    return self._qty
+
+  @qty.setter
+  def qty(self, qty):
+    if type(qty) not in PLAIN:
+      qty = exact(qty)
+    weight = (qty or 0) - (self._qty or 0)
+    self._qty = qty
+    if weight:
+      self.carry(weight)
+    if TRACE:
+      TRACE.change(Trace.QTY, self, qty)
+
+  @property
+  def writing(self):
+    return self._writing
+
+  @writing.setter
+  def writing(self, lines):
+    self._writing = lines
+    self.orders = None
+    if TRACE:
+      TRACE.change(Trace.WRITE, self, lines)
 
   def write(self, text):
-    self.writing += [line.strip() for line in text.split(';')]
+    self.append([line.strip() for line in text.split(';')])
+
+  def append(self, lines):
+    if not self.writing:
+      self.writing = lines
+      return
+    writing = self._writing
+    writing += lines  # In place, unless it's a printout
+    self._writing = writing
+    self.orders = None
+    if TRACE:
+      TRACE.change(Trace.APPEND, self, lines)
+
+  def procedure(self):
+    # What's been made of the orders written here, kept until they change.
+    # A printout too long to keep parsed is parsed line by line as it's
+    # followed.
+    if self.orders is None:
+      writing = self._writing
+      self.orders = Procedure(not isinstance(writing, Printout) or
+                              len(writing) <= CACHED)
+    return self.orders
 
   def match(self, spec):
     result = not not spec.selector
@@ -230,15 +688,23 @@ class Item(Vessel):
     return result
 
   def weight(self):
-    return (self.qty or 0) + sum([i.weight() for i in self.items])
+    return (self._qty or 0) + self.load + self.fraction
+
+  def __getstate__(self):
+    # The orders made of the writing aren't kept, but made again as needed
+    state = slotted(self)
+    state['orders'] = None
+    return None, state
   
 
 class Furniture(Item):
+  __slots__ = ()
   def __init__(self, phrase, location, description=None,
                capacity=float('inf'), closed=None, locked=None):
     Item.__init__(self, phrase, location, description=description,
                   capacity=capacity, closed=closed, locked=locked)
-    self.fixed = True
+
+  fixed = True
 
 
 VERBS = {}
@@ -269,40 +735,56 @@ class Verb:
         self.objects.append(parseparam(usage.pop(0)))
     VERBS[self.verb] = self
 
-  def do(self, subject, input):
+  def bind(self, input):
+    # Work out, once, which words go to which arguments
     input = input[:]
-    arguments = {}
+    plan = []
     nobjects = 0
     while input:
       parameter = self.pps.get(input[0].lower())
       if parameter:
         input.pop(0)
       elif nobjects >= len(self.objects):
-        return say('You lost me at "' + input[0] + '".')
+        plan.append((None, ('You lost me at "' + input[0] + '".',)))
+        return plan
       else:
         parameter = self.objects[nobjects]
         nobjects += 1
 
       if parameter['type'] == 'str':
-        arguments[parameter['name']] = input.pop(0)
+        plan.append((parameter['name'], input.pop(0)))
       else:
-        root = subject if parameter['held'] else subject.location
-        ob = subject.resolve(input, root,
-                             parameter['multi'], parameter['type'])
-        if not ob:
-          return
-        arguments[parameter['name']] = ob
+        ref = Reference(input, parameter['multi'], parameter['type'],
+                        parameter['held'])
+        plan.append((parameter['name'], ref))
+        if ref.error:
+          return plan
 
     if (nobjects < len(self.objects) and
         not self.objects[nobjects]['optional']):
-      return say(self.verb, 'what', self.objects[nobjects]['name'] + '?')
+      plan.append((None, (self.verb, 'what',
+                          self.objects[nobjects]['name'] + '?')))
+      return plan
     for p,v in self.pps.items():
-      if v['name'] not in arguments:
+      if v['name'] not in [name for name,_ in plan]:
         if not v['optional']:
-          return say(self.verb, p, 'what?')
+          plan.append((None, (self.verb, p, 'what?')))
+          return plan
         else:
-          arguments[v['name']] = None
+          plan.append((v['name'], None))
+    return plan
 
+  def run(self, subject, plan):
+    arguments = {}
+    for name, value in plan:
+      if name is None:
+        return say(*value)
+      if isinstance(value, Reference):
+        value = value.resolve(subject,
+                              subject if value.held else subject.location)
+        if not value:
+          return
+      arguments[name] = value
     return getattr(subject, self.verb)(**arguments)
 
 
@@ -312,16 +794,28 @@ class Itemspec:
     self.noun = None
     self.name = None
     self.selector = None
-    def q0(ws):
-      return (q and q[0].lower() in ws and q.pop(0)) or None
-    q0(['the'])
-    self.selector = q0(('all','first','last'))
-    self.adjective = q0(ADJECTIVES)
-    self.noun = q0(NOUNS)
-    if q0(['called']):
+    # Each word is looked up once, for all the things it might be
+    def q0():
+      return KINDS.get(q[0].lower(), 0) if q else 0
+    kind = q0()
+    if kind & THE:
+      q.pop(0)
+      kind = q0()
+    if kind & SELECTOR:
+      self.selector = q.pop(0) or None
+      kind = q0()
+    if kind & ADJECTIVE:
+      self.adjective = q.pop(0) or None
+      kind = q0()
+    if kind & NOUN:
+      self.noun = q.pop(0) or None
+      kind = q0()
+    if kind & CALLED:
+      q.pop(0)
       self.name = q and q.pop(0)
+      kind = q0()
     if not (self.adjective or self.noun or self.name):
-      self.name = q0(NAMES)
+      self.name = (kind & NAME and q.pop(0)) or None
 
   def __bool__(self):
     return not not (self.adjective or self.noun or self.name or self.selector)
@@ -334,53 +828,315 @@ class Itemspec:
             ' '.join([w for w in self.selector, self.adjective, self.noun, self.name if w]))
 
 
-class Entity(Item):
-  def __init__(self, phrase, location, description):
-    Item.__init__(self, phrase, location, description, capacity=9)
-    self.mobile = True
-    self.active = True
-    self.stack = []
-
-  def resolve(self, q, root, multi=False, type=None):
-    if q[0] == 'self':
-      q.pop(0)
-      return self
-    elif q[0] == 'here':
-      q.pop(0)
-      return self.location
+class Reference(object):
+  def __init__(self, q, multi=False, type=None, held=False):
+    self.type = type
+    self.multi = multi
+    self.held = held
+    self.pronoun = self.spec = self.inner = self.error = None
+    if q[0] in ('self', 'here'):
+      self.pronoun = q.pop(0)
+      return
 
-    spec = Itemspec(q)
+    spec = self.spec = Itemspec(q)
     if spec.name == q:
-      return say('Called what?')
+      self.error = ('Called what?',)
     elif spec.selector == 'all' and not multi:
-      return say("You can't specify multiple objects in this context.")
-
-    if not spec:
-      return say("I didn't understand. " + Cap(q[0]) + "?")
-
-    if q and q[0] == 'in':
+      self.error = ("You can't specify multiple objects in this context.",)
+    elif not spec:
+      self.error = ("I didn't understand. " + Cap(q[0]) + "?",)
+    elif q and q[0] == 'in':
       q.pop(0)
-      root = self.resolve(q, root)
+      self.inner = Reference(q)
+
+  def resolve(self, subject, root):
+    if self.error:
+      return say(*self.error)
+    elif self.pronoun == 'self':
+      return subject
+    elif self.pronoun == 'here':
+      return subject.location
+
+    spec = self.spec
+    if self.inner:
+      root = self.inner.resolve(subject, root)
       if not root:
         return say("I don't see a", spec, "there.")
     objs = root.find(spec)
     if not objs:
-      return say('What ' + str(spec) + '?')
+      return say(Later('What %s?', spec))
     elif len(objs) > 1 and spec.selector != 'all':
-      return say('Which ' + str(spec) + '?')
-    if type:
+      return say(Later('Which %s?', spec))
+    if self.type:
       for obj in objs:
-        if type != obj.type:
-          return say('The', obj, "can't be used for that.", type, obj.type)
-    return objs if multi else objs[0]
-      
+        if self.type != obj.type:
+          return say('The', obj, "can't be used for that.", self.type, obj.type)
+    return objs if self.multi else objs[0]
+
+
+# Lines are split into words the way a POSIX shell would, as shlex.split()
+# does but much more quickly: most have no quotes or escapes at all
+SPECIAL = re.compile(r'["\'\\\x0b\x0c]')
+TOKEN = re.compile(r'''([^ \t\r\n"'\\]+)|([ \t\r\n]+)|"((?:[^"\\]|\\.)*)"|'([^']*)'|\\(.)''',
+                   re.S)
+ESCAPED = re.compile(r'\\(["\\])')
+UNESCAPED = re.compile(r'"(?:[^"\\]|\\.)*\\\Z', re.S)  # Quote ending in \
+
+def split(line):
+  if not SPECIAL.search(line):
+    return line.split()
+  words = []
+  word = None
+  pos = 0
+  while pos < len(line):
+    match = TOKEN.match(line, pos)
+    if not match:
+      if line[pos] == '\\' or UNESCAPED.match(line, pos):
+        raise ValueError('No escaped character')
+      raise ValueError('No closing quotation')
+    pos = match.end()
+    plain, space, double, single, escaped = match.groups()
+    if space is not None:
+      if word is not None:
+        words.append(word)
+      word = None
+      continue
+    if double is not None:
+      plain = ESCAPED.sub(r'\1', double)
+    word = (word or '') + (plain or single or escaped or '')
+  if word is not None:
+    words.append(word)
+  return words
+
+
+class Command(object):
+  # A line parsed. Unless it's to be kept, it's performed once and thrown
+  # away, so its words needn't be noted in PARSED.
+  def __init__(self, line, kept=True):
+    self.line = line
+    self.words = [ALIASES.get(word,word) for word in split(line.strip())]
+    self.epoch = None
+    self.kept = kept
+
+  def prepare(self):
+    global EPOCH
+    if self.kept:
+      if len(PARSED) > WORDS:
+        # Forget the words, and have every cached command parsed afresh, so
+        # that their words are noted again as they're used
+        PARSED.clear()
+        EPOCH += 1
+      PARSED.update([word.lower() for word in self.words])
+    self.epoch = EPOCH
+    self.verb = self.plan = self.direction = None
+    words = self.words[1:]
+    command = self.words[0].lower()
+    if command in VERBS:
+      self.verb = VERBS[command]
+      self.plan = self.verb.bind(words)
+    elif command in DIRECTIONS:
+      self.direction = command
+
+  def perform(self, subject):
+    if not self.words:
+      return
+    if self.epoch != EPOCH:
+      self.prepare()
+
+    if self.verb:
+      self.verb.run(subject, self.plan)
+
+    elif self.direction:
+      subject.go(self.direction)
+
+    else:
+      say('I did not understand that.')
+
+    if CHANGED:
+      settle()
+
+  def compile(self, cls):
+    # A function doing what perform() does for subjects of class cls, with
+    # the verb's method, literal arguments and references found up front
+    if not self.words:
+      return lambda subject: None
+    if self.epoch != EPOCH:
+      self.prepare()
+
+    if self.direction:
+      go = cls.go.im_func
+      direction = self.direction
+      def step(subject):
+        go(subject, direction)
+        if CHANGED:
+          settle()
+      return step
+
+    if not self.verb:
+      def step(subject):
+        say('I did not understand that.')
+        if CHANGED:
+          settle()
+      return step
+
+    method = getattr(cls, self.verb.verb).im_func
+    literals = {}
+    references = []
+    error = None
+    for name, value in self.plan:
+      if name is None:
+        error = value
+      elif isinstance(value, Reference):
+        references.append((name, value, value.held))
+      else:
+        literals[name] = value
+
+    if not references and not error:
+      def step(subject):
+        method(subject, **literals)
+        if CHANGED:
+          settle()
+      return step
+
+    def step(subject):
+      arguments = literals.copy()
+      for name, reference, held in references:
+        value = reference.resolve(subject,
+                                  subject if held else subject.location)
+        if not value:
+          break
+        arguments[name] = value
+      else:
+        if error:
+          say(*error)
+        else:
+          method(subject, **arguments)
+      if CHANGED:
+        settle()
+    return step
+
+
+class Procedure(object):
+  # Commands parsed from a set of orders, by line. Once the orders have
+  # been obeyed HOT times, lines are compiled as they come up, for the
+  # class of whoever is obeying; anyone else gets the parsed commands. At
+  # most CACHED lines of each are kept, and none once EPOCH has moved on.
+  # Unless cached, each line's parsed afresh every time it's followed.
+  def __init__(self, cached=True):
+    self.cached = cached
+    self.commands = {}
+    self.obeyed = 0
+    self.steps = {}
+    self.cls = None
+    self.epoch = None
+
+  def command(self, line):
+    if not self.cached:
+      return Command(line, False)
+    if self.epoch != EPOCH:
+      self.commands, self.steps = {}, {}
+      self.epoch = EPOCH
+    command = self.commands.get(line)
+    if not command:
+      if len(self.commands) >= CACHED:
+        self.commands = {}
+      command = self.commands[line] = Command(line)
+    return command
+
+  def step(self, line, subject):
+    if self.obeyed < HOT or not self.cached:
+      return self.command(line).perform
+    if self.epoch != EPOCH:
+      self.commands, self.steps = {}, {}
+      self.epoch = EPOCH
+    if not self.cls:
+      self.cls = type(subject)
+    if type(subject) is not self.cls:
+      return self.command(line).perform
+    step = self.steps.get(line)
+    if not step:
+      if len(self.steps) >= CACHED:
+        self.steps = {}
+      step = self.steps[line] = self.command(line).compile(self.cls)
+    return step
+
+  def __getstate__(self):
+    # What's been parsed and compiled isn't kept, but made again as needed
+    state = self.__dict__.copy()
+    state.update(commands={}, steps={}, epoch=None)
+    return state
+
+
+class Frame(object):
+  # A set of orders being followed: the lines, and which one is next, and
+  # where they came from. When profiling, path holds the lines obeyed to
+  # get here.
+  def __init__(self, lines, procedure, source):
+    self.lines = lines
+    self.procedure = procedure
+    self.source = source
+    self.next = 0
+    self.path = ()
+    self.label = None
+
+  def __getstate__(self):
+    # What's been made of the lines isn't kept, but made again
+    state = self.__dict__.copy()
+    del state['procedure']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if getattr(self.source, 'writing', None) is self.lines:
+      self.procedure = self.source.procedure()
+    else:
+      self.procedure = Procedure()
+
+  def done(self):
+    # Whether these orders have been followed to the end, for good. Lines
+    # written on the parchment being followed are added to these very
+    # lines, so they aren't done while that's still what's written there.
+    return (self.next >= len(self.lines) and
+            (type(self.lines) is not list or
+             getattr(self.source, 'writing', None) is not self.lines))
+
+  def waiting(self, stack):
+    # Whether, under this frame at the top of stack and with only frames at
+    # their ends in between, another's waiting at the same place in the
+    # same lines
+    for below in xrange(len(stack) - 2, -1, -1):
+      other = stack[below]
+      if other.next < len(other.lines):
+        return False
+      if other.lines is self.lines and other.next == self.next:
+        return True
+    return False
+
+  def where(self):
+    if not self.label:
+      source = self.source
+      self.label = '"' + source.name + '"' if source.name else str(source)
+    return self.label + ':' + str(self.next)
+
+
+class Entity(Item):
+  # Orders an entity's given go on its stack, and it follows them in turns
+  # with any other entities that have orders of their own (see turns())
+  __slots__ = ('active', 'stack', 'running')
+  mobile = True
+
+  def __init__(self, phrase, location, description):
+    Item.__init__(self, phrase, location, description, capacity=9)
+    self.active = True
+    self.stack = []  # Frames of orders being followed, innermost last
+    self.running = False  # Whether it's waiting its turn, or taking it
 
   Verb('INVENTORY')
   def inventory(self):
     if self.items:
       say('You are currently holding:')
       for item in self.items:
-        say('  ' + Cap(item.describe(True)) + '.')
+        say(Later(listed, item))
     else:
       say('You are empty-handed.')
 
@@ -396,7 +1152,9 @@ class Entity(Item):
   Verb('WRITE text:str WITH :pen@ ON paper:parchment')
   def write(self, text, pen, paper):
     paper.write(text)
-    say('You write on the', str(paper) + '.')
+    say(Later('You write on the %s.', paper))
+    if PREFETCH and FILES and self.location is LANDMARKS['coop'].location:
+      prefetch(paper.writing[0])
 
   Verb('DIG WITH :shovel@ IN where?')
   def dig(self, shovel, where):
@@ -405,7 +1163,7 @@ class Entity(Item):
       if 'dig' not in where.resources:
         say("Digging here is fruitless.")
       else:
-        item = Item(self.location.resources['dig'], None, qty=1.0)
+        item = Item(self.location.resources['dig'], None, qty=1)
         if item.move(self):
           say('You dig up some', item, 'and add it to your inventory.')
     else:
@@ -416,7 +1174,7 @@ class Entity(Item):
         dirts[0].move(self, 'You dig out the', dirts[0],
                       'and add it to your inventory.')
       else:
-        item = Item('dirt', None, qty=1.0)
+        item = Item('dirt', None, qty=1)
         if item.move(self):
           dirts[0].qty -= 1
           say('You dig out some', item, 'and add it to your inventory.')
@@ -425,17 +1183,19 @@ class Entity(Item):
 
   Verb('ERASE :parchment')
   def erase(self, parchment):
-    parchment.writing = []
-    say('You erase everything written on the ' + str(parchment) + '.')
+    parchment.writing = ()
+    say(Later('You erase everything written on the %s.', parchment))
 
   Verb('LOOK thing?')
   def look(self, thing=None):
-    say((thing or self.location).describe())
+    say(Later((thing or self.location).describe))
 
   Verb('CALL item name:str')
   def call(self, item, name):
-    item.name = None
-    desc = str(item)
+    desc = None
+    if FEEDBACK:
+      item.name = None
+      desc = str(item)
     item.name = name
     say("We'll call the", desc, '"' + item.name + '" from now on.')
 
@@ -448,11 +1208,12 @@ class Entity(Item):
     elif vessel.locked:
       say('The', vessel, 'is locked.')
     else:
-      vessel.closed = False
+      alter(vessel, 'closed', False)
+      changed(vessel, 'closed')
       if vessel.items:
         say('Opening the', vessel, 'reveals:')
         for item in vessel.items:
-          say('  ' + Cap(item.describe(True)) + '.')
+          say(Later(listed, item))
       else: 
         say('The', vessel, 'is now open. It is empty.')
 
@@ -463,9 +1224,9 @@ class Entity(Item):
     elif vessel.closed != False:
       say('The', vessel, 'is already closed.')
     else:
-      vessel.closed = True
+      alter(vessel, 'closed', True)
       say('The', vessel, 'is now closed.')
-      vessel.onClose()
+      changed(vessel, 'closed')
 
   Verb('UNLOCK vessel')
   def unlock(self, vessel):
@@ -474,8 +1235,8 @@ class Entity(Item):
     elif not vessel.locked:
       say('The', vessel, 'is not locked.')
     else:
-      vessel.locked = False
-      say('You unlock the', str(vessel) + '.')
+      alter(vessel, 'locked', False)
+      say(Later('You unlock the %s.', vessel))
 
   Verb('LOCK vessel')
   def lock(self, vessel):
@@ -486,8 +1247,8 @@ class Entity(Item):
     elif vessel.locked:
       say('The', vessel, 'is already locked.')
     else:
-      vessel.locked = True
-      say('You lock the', str(vessel) + '.')
+      alter(vessel, 'locked', True)
+      say(Later('You lock the %s.', vessel))
 
   Verb('TELL whom speech:str')
   def tell(self, whom, speech):
@@ -501,22 +1262,22 @@ class Entity(Item):
   Verb('TAKE *items')
   def take(self, items):
     for item in items:
-      item.move(self, str(item) + ' taken.')
+      item.move(self, item, 'taken.')
 
   Verb('DROP *items@')
   def drop(self, items):
     for item in items:
-      item.move(self.location, str(item) + ' dropped.')
+      item.move(self.location, item, 'dropped.')
 
   Verb('PUT *items@ INTO vessel')
   def put(self, items, vessel):
     for item in items:
-      item.move(vessel, 'You put the', item, 'into the', str(vessel) + '.')
+      item.move(vessel, Later('You put the %s into the %s.', item, vessel))
 
   Verb('GIVE *items@ TO vessel')
   def give(self, items, vessel):
     for item in items:
-      item.move(vessel, 'You give the', item, 'to the', str(vessel) + '.')
+      item.move(vessel, Later('You give the %s to the %s.', item, vessel))
 
   Verb('XYZZY')
   def xyzzy(self):
@@ -529,7 +1290,7 @@ class Entity(Item):
   Verb('QUIT')
   def quit(self):
     say('Goodbye!')
-    self.active = False
+    alter(self, 'active', False)
 
   Verb('THINK concept:str')
   def think(self, concept):
@@ -545,48 +1306,140 @@ class Entity(Item):
 
   Verb('OBEY orders')
   def obey(self, orders):
-    self.stack.append(orders)
+    self.follow(Frame(orders.writing, orders.procedure(), orders))
+
+  def follow(self, frame):
+    stack = self.stack
+    if stack and stack[-1].next >= len(stack[-1].lines):
+      # The caller has nothing left to do, so replace it, unless more may
+      # yet be written for it to follow once frame's done. Even then, if
+      # there's another waiting at the same place in the same lines, it's
+      # left to that one, so loops still run in constant depth.
+      caller = stack[-1]
+      if caller.done() or caller.waiting(stack):
+        frame.path = stack.pop().path
+      elif PROFILE:
+        frame.path = PROFILE.path()
+    elif PROFILE:
+      frame.path = PROFILE.path()
+    if len(stack) >= MAX_DEPTH:
+      raise ColossalError('Orders nested more than %d deep' % MAX_DEPTH)
+    stack.append(frame)
+    if len(stack) > STATS['depth']:
+      STATS['depth'] = len(stack)
+    frame.procedure.obeyed += 1
     self.active = True
-    for line in orders.writing:
+    if not self.running:
+      self.running = True
+      BUSY.append(self)
+
+  def run(self, budget=None):
+    # Follow orders until there are none left, or until budget commands
+    # have been followed; returns what's left of the budget. Orders obeyed
+    # along the way are pushed onto the stack and picked up here rather
+    # than recursing.
+    stack = self.stack
+    while stack:
+      frame = stack[-1]
       if not self.active:
+        del stack[:]
+      elif frame.next >= len(frame.lines):
+        stack.pop()
+      elif budget == 0:
         break
-      say('>' * (len(self.stack)+1), line)
-      self.parse(line)
-    self.stack.pop()
+      else:
+        if budget:
+          budget -= 1
+        line = frame.lines[frame.next]
+        frame.next += 1
+        if TRACE:
+          TRACE.command(self, line)
+        STATS['commands'] += 1
+        if FEEDBACK:
+          say('>' * (len(stack)+1), line)
+        if PROFILE:
+          PROFILE.begin(frame.path + (frame.where(),), line)
+          frame.procedure.step(line, self)(self)
+          PROFILE.end()
+        else:
+          frame.procedure.step(line, self)(self)
+    return budget
 
 
   def parse(self, line):
-    words = [ALIASES.get(word,word) for word in shlex.split(line.strip())]
-    if not words:
-      return
-
-    command = words.pop(0).lower()
-
-    if command in VERBS:
-      VERBS[command].do(self, words)
-
-    elif command in DIRECTIONS:
-      self.go(command)
-
-    else:
-      say('I did not understand that.')
-
-    self.location.onTick()
+    Command(line, False).perform(self)
 
 
   def execute(self, lines=None):
-    if lines:
+    # Follows lines, or if there are none (not just an empty script), what
+    # the player types
+    if lines is not None:
       for line in lines:
         if not self.active:
           break
-        say('\n>', line.strip())
-        self.parse(line)
+        if FEEDBACK:
+          say('\n>', line.strip())
+        if TRACE:
+          TRACE.command(self, line)
+        STATS['commands'] += 1
+        if PROFILE:
+          where = (hasattr(lines, 'filename') and
+                   '%s:%d' % (lines.filename(), lines.filelineno()))
+          PROFILE.begin((where or '<input>',), line)
+          self.parse(line)
+          PROFILE.end()
+        else:
+          self.parse(line)
+        turns()
+        if CHECKPOINT:
+          CHECKPOINT.tick()
+        due()
     else:
       while self.active:
-        self.parse(raw_input('\n> '))
-    
+        if OUTPUT:
+          OUTPUT.flush()
+        if FEEDBACK:
+          FEEDBACK.flush()
+        line = raw_input('\n> ')
+        if TRACE:
+          TRACE.command(self, line)
+        STATS['commands'] += 1
+        self.parse(line)
+        turns()
+        if CHECKPOINT:
+          CHECKPOINT.tick()
+        due()
+
+
+def turns(budget=None):
+  # Has the entities with orders to follow take turns following TURN
+  # commands at a time, round robin in the order they were given them,
+  # until they're done or budget commands have been followed; returns
+  # what's left of the budget. An entity whose orders go wrong loses them.
+  while BUSY and budget != 0:
+    entity = BUSY[0]
+    turn = TURN if budget is None else min(TURN, budget)
+    try:
+      left = entity.run(turn)
+    except:
+      del entity.stack[:]
+      entity.running = False
+      BUSY.popleft()
+      raise
+    if budget is not None:
+      budget -= turn - left
+    BUSY.popleft()
+    if entity.stack:
+      BUSY.append(entity)
+    else:
+      entity.running = False
+    if CHECKPOINT:
+      CHECKPOINT.tick()
+    due()
+  return budget
 
 class Player(Entity):
+  __slots__ = ('visited',)
   def __init__(self, location):
     self.visited = set()
     Entity.__init__(self,
@@ -594,82 +1447,101 @@ class Player(Entity):
                     location,
                     "You are you. That's just who you are.")
   def onArrive(self):
-    say(self.location.describe(self.location.name in self.visited))
-    self.visited.add(self.location.name)
+    say(Later(self.location.describe, self.location.name in self.visited))
+    if self.location.name not in self.visited:
+      self.visited.add(self.location.name)
+      if TRACE:
+        TRACE.change(Trace.VISIT, self, self.location.name)
 
 
 
 #=============================================================================#
 
-osh = Room('Outside of a small house',
-           'The day is warm and sunny. Butterflies careen about and bees hum from blossom to blossom. The smell of peonies and adventure fills the air.\n\nYou stand on a poor road running east-west, outside of a small house painted white. Planted in the ground in front of the house is a mailbox.',
-           { 'east': 'Dirt road',
-             'west': 'Crossroads',
-             'cheat': 'Cheaterville',
-             'in': 'Inside the small house' })
-mailbox = Furniture('mailbox',
-                    osh,
-                    'A fairly ordinary mailbox, used mostly to receive mail. The kind with a flag on the side and so forth. The number "200" is proudly emblazoned with vinyl stickers on one side.',
-                    capacity=3,
-                    closed=True)
+LANDMARKS = {}  # Mapping from names to the things devices need to find
+SECTIONS = []  # The functions that build the world, in order
+
+def section(build):
+  SECTIONS.append(build)
+  return build
 
 #-----------------------------------------------------------------------------#
 
-cv = Room('Cheaterville',
-          'Nothing to see here. Move along.',
-          { 'uncheat': osh })
-b = Item('nut bag', cv, capacity=float('inf'))
-b.name = 'rex'
+@section
+def outside_of_a_small_house():
+  osh = Room('Outside of a small house',
+             'The day is warm and sunny. Butterflies careen about and bees hum from blossom to blossom. The smell of peonies and adventure fills the air.\n\nYou stand on a poor road running east-west, outside of a small house painted white. Planted in the ground in front of the house is a mailbox.',
+             { 'east': 'Dirt road',
+               'west': 'Crossroads',
+               'cheat': 'Cheaterville',
+               'in': 'Inside the small house' })
+  LANDMARKS['mailbox'] = Furniture('mailbox',
+                                    osh,
+                                    'A fairly ordinary mailbox, used mostly to receive mail. The kind with a flag on the side and so forth. The number "200" is proudly emblazoned with vinyl stickers on one side.',
+                                    capacity=3,
+                                    closed=True)
+
+#-----------------------------------------------------------------------------#
 
+@section
+def cheaterville():
+  cv = Room('Cheaterville',
+            'Nothing to see here. Move along.',
+            { 'uncheat': ROOMS['Outside of a small house'] })
+  b = Item('nut bag', cv, capacity=float('inf'))
+  b.name = 'rex'
 
 #-----------------------------------------------------------------------------#
 
-Room('Inside the small house',
-     'The house is decorated in an oppressively cozy country style. There are needlepoints on every wall and pillow, and the furniture is overstuffed and outdated. Against one overdecorated wall stands a case designed to display little league trophies and the like.',
-     { 'out': 'Outside of a small house' })
 class TrophyCase(Furniture):
-  def onClose(self):
-    if self.items:
+  __slots__ = ()
+  WATCH = ('closed',)
+  def onChange(self, events):
+    if self.closed and self.items:
       say('AN INFINITE EXHILARATION THRUMS IN YOUR HEART')
       for item in self.items:
         output(item.writing)
         say('The', item, 'vanishes!')
         item.move(None)
-TrophyCase('trophy case',
-           'Inside the small house',
-           'This handsome case offers display space for a few treasured items.',
-           capacity=3,
-           closed=True,
-           locked=True);
+@section
+def inside_the_small_house():
+  Room('Inside the small house',
+       'The house is decorated in an oppressively cozy country style. There are needlepoints on every wall and pillow, and the furniture is overstuffed and outdated. Against one overdecorated wall stands a case designed to display little league trophies and the like.',
+       { 'out': 'Outside of a small house' })
+  TrophyCase('trophy case',
+             'Inside the small house',
+             'This handsome case offers display space for a few treasured items.',
+             capacity=3,
+             closed=True,
+             locked=True);
 
 #-----------------------------------------------------------------------------#
 
-Room('Dirt road',
-     "You stand on a dirt road running east-west. The road is dirt. It's quite dirty. Beside the road is also dirt; there's dirt everywhere, in fact. Piles and piles of dirt, all around you!",
-     { 'east': 'Fork in the road',
-       'west': 'Outside of a small house' },
-     resources={ 'dig': 'dirt' })
-Item('shovel', 'Dirt road')
+@section
+def dirt_road():
+  Room('Dirt road',
+       "You stand on a dirt road running east-west. The road is dirt. It's quite dirty. Beside the road is also dirt; there's dirt everywhere, in fact. Piles and piles of dirt, all around you!",
+       { 'east': 'Fork in the road',
+         'west': 'Outside of a small house' },
+       resources={ 'dig': 'dirt' })
+  Item('shovel', 'Dirt road')
 
 #-----------------------------------------------------------------------------#
 
 class TarPit(Room):
+  __slots__ = ()
   def onTake(self, item, source):
     item.move(None)
     say('The', item, 'sinks into the tar!')
-TarPit('Tar pit',
-       'The road leads to a noxious pit of tar. It emits noxious fumes and bubbles langoriously from time to time. Amidst the tar, out of reach, a tar-encrusted T-rex bobs, half-submerged.',
-       { 'east': 'Crossroads' });
+@section
+def tar_pit():
+  TarPit('Tar pit',
+         'The road leads to a noxious pit of tar. It emits noxious fumes and bubbles langoriously from time to time. Amidst the tar, out of reach, a tar-encrusted T-rex bobs, half-submerged.',
+         { 'east': 'Crossroads' });
 
 #-----------------------------------------------------------------------------#
 
-Room('Crossroads',
-     'You stand at a crossroads. Also, there are roads leading in all the cardinal directions.',
-     { 'north': 'Dunno...',
-       'south': 'Not sure',
-       'east': 'Outside of a small house',
-       'west': 'Tar pit' });
 class Devil(Entity):
+  __slots__ = ()
   def onHear(self, speech, source):
     say("\"Hello, friend. It's you're good fortune that we meet today. I can see you've had a hard lot in life, been treated unfairly. You've never gotten half the respect you deserve, and never half the material rewards either. The life you've led, you should be a rich man instead of leading the small life those ingrates have alloted. I can mend all that to some small degree. Its not as much as you deserve, perhaps, but for the mere price of a soul, I'll double your lot. There, that's surely worth the pittance I ask, is it not? One worn, tiny soul to make you twice the person you are now?\"")
   def onTake(self, item, source):
@@ -683,247 +1555,326 @@ class Devil(Entity):
         if item.qty:
           item.qty *= 2
           say("Your supply of", item.noun, "is doubled.")
-Devil('devil', 'Crossroads',
-       "This is the Lord Beelzebub. Satan. Lucifer. You've heard the stories. He's just hanging around here, not really doing too much. Just thinking about stuff.").name = 'Satan'
-Item('soul', 'Crossroads')
+@section
+def crossroads():
+  Room('Crossroads',
+       'You stand at a crossroads. Also, there are roads leading in all the cardinal directions.',
+       { 'north': 'Dunno...',
+         'south': 'Not sure',
+         'east': 'Outside of a small house',
+         'west': 'Tar pit' });
+  Devil('devil', 'Crossroads',
+         "This is the Lord Beelzebub. Satan. Lucifer. You've heard the stories. He's just hanging around here, not really doing too much. Just thinking about stuff.").name = 'Satan'
+  Item('soul', 'Crossroads')
 
 #-----------------------------------------------------------------------------#
 
-Room('Dunno...',
-     "I'm not sure what we're looking at here. I just don't know how to describe it. It's just...\nThe road continues north-south. Other than that it's just really indescribable. (Sorry.)",
-     { 'north': 'Bend',
-       'south': 'Crossroads' })
-Item('something', 'Dunno...',
-     'What the hell is this thing?')
+@section
+def dunno():
+  Room('Dunno...',
+       "I'm not sure what we're looking at here. I just don't know how to describe it. It's just...\nThe road continues north-south. Other than that it's just really indescribable. (Sorry.)",
+       { 'north': 'Bend',
+         'south': 'Crossroads' })
+  Item('something', 'Dunno...',
+       'What the hell is this thing?')
 
 #-----------------------------------------------------------------------------#
 
-Room('Bend',
-     "The road bends sharply south-to-east here, but a trail of camel shit leads north into some sort of stone-walled enclosure.",
-     { 'north': 'Caravanserai',
-       'south': 'Dunno',
-       'east': 'More road' })
+@section
+def bend():
+  Room('Bend',
+       "The road bends sharply south-to-east here, but a trail of camel shit leads north into some sort of stone-walled enclosure.",
+       { 'north': 'Caravanserai',
+         'south': 'Dunno',
+         'east': 'More road' })
 
 #-----------------------------------------------------------------------------#
 
-Room('Caravanserai',
-     'You stand in a large square walled enclosure. The middle is an open cobbled courtyard, which is surrounded on all sides by roofed stalls. Most of these contain fodder for camels and just camels and camel drovers doing camel stuff. One stall that catches your eye is floored in rich carpets.',
-     { 'in': 'Stall',
-       'south': 'Bend',
-       'out': 'Bend' })
+@section
+def caravanserai():
+  Room('Caravanserai',
+       'You stand in a large square walled enclosure. The middle is an open cobbled courtyard, which is surrounded on all sides by roofed stalls. Most of these contain fodder for camels and just camels and camel drovers doing camel stuff. One stall that catches your eye is floored in rich carpets.',
+       { 'in': 'Stall',
+         'south': 'Bend',
+         'out': 'Bend' })
 
 #-----------------------------------------------------------------------------#
 
-Room('Stall',
-     "This particular stall stands out from the rest due to it's rich appointments. Silk hangings enclose it, and ornate rugs carpet the floor.",
-     { 'out': 'Caravanserai' })
 class Lamp(Item):
+  __slots__ = ()
   def onRub(self, rubber):
     say("Haha. That does absolutely nothi- Oh, crapsticks! Wait! An actual genie appears! Aw, just kidding.")
-Lamp("golden lamp", 'Stall')
+@section
+def stall():
+  Room('Stall',
+       "This particular stall stands out from the rest due to it's rich appointments. Silk hangings enclose it, and ornate rugs carpet the floor.",
+       { 'out': 'Caravanserai' })
+  Lamp("golden lamp", 'Stall')
 
 #-----------------------------------------------------------------------------#
 
-Room('Fork in the road',
-     'The road leading in from the west forks here. The northeast fork seems to head towards a rocky, hilly area. The road to the southeast is narrower and lined with tall grass. Not much more to say about it than that. Should I mention the bees and butterflies again?',
-     { 'west': 'Dirt road',
-       'northeast': 'Mouth of a cave',
-       'southeast': 'Grassy knoll', })
+@section
+def fork_in_the_road():
+  Room('Fork in the road',
+       'The road leading in from the west forks here. The northeast fork seems to head towards a rocky, hilly area. The road to the southeast is narrower and lined with tall grass. Not much more to say about it than that. Should I mention the bees and butterflies again?',
+       { 'west': 'Dirt road',
+         'northeast': 'Mouth of a cave',
+         'southeast': 'Grassy knoll', })
 
 #-----------------------------------------------------------------------------#
 
 class GrassyKnoll(Room):
+  __slots__ = ()
   def onTake(self, whom, source):
     if whom.type == 'You':
       item = whom.items and random.choice(whom.items)
       if item and item.move(ROOMS['Deep grass']):
-        say('Goddamn that Bograt. He stole your', str(item) + '. Then he tossed it somewhere into the deep grass.')
-GrassyKnoll('Grassy knoll',
-            'A path leading from the northwest gives onto a grassy knoll. The knoll is home to a greasy gnoll. A gnoll is a cross between a gnome and a troll. This particular gnoll is named Bograt, and Bograt, I am sorry to tell you, is a jerk.',
-            { 'northwest': 'Fork in the road' })
-Item('gnoll',
-     'Grassy knoll',
-     'Bograt is a greasy gnoll who lives on a grassy knoll. No two ways about it: he is a jerk.').name = 'Bograt'
+        say(Later('Goddamn that Bograt. He stole your %s. Then he tossed it somewhere into the deep grass.', item))
+@section
+def grassy_knoll():
+  GrassyKnoll('Grassy knoll',
+              'A path leading from the northwest gives onto a grassy knoll. The knoll is home to a greasy gnoll. A gnoll is a cross between a gnome and a troll. This particular gnoll is named Bograt, and Bograt, I am sorry to tell you, is a jerk.',
+              { 'northwest': 'Fork in the road' })
+  Item('gnoll',
+       'Grassy knoll',
+       'Bograt is a greasy gnoll who lives on a grassy knoll. No two ways about it: he is a jerk.').name = 'Bograt'
 
 #-----------------------------------------------------------------------------#
 
-Room('Deep grass',
-     "The grass here is deep. It's like a needle in a haystack, minus the needle in here.",
-     { 'out': 'Grassy knoll' })
+@section
+def deep_grass():
+  Room('Deep grass',
+       "The grass here is deep. It's like a needle in a haystack, minus the needle in here.",
+       { 'out': 'Grassy knoll' })
 
 #-----------------------------------------------------------------------------#
 
-Room('Mouth of a cave',
-     "The jaws of a cave yawn before you. To continue the metaphor, the cave's acrid breath recalls overcooked garlic bread. Sharp teeth (and here I'm hinting at stactites and stalagmites) gnash (poetically speaking) at the lips of the cave. I think that's descriptive enough.",
-     { 'southwest': 'Fork in the road',
-       'north': 'Cave foyer',
-       'in': 'Cave foyer' })
+@section
+def mouth_of_a_cave():
+  Room('Mouth of a cave',
+       "The jaws of a cave yawn before you. To continue the metaphor, the cave's acrid breath recalls overcooked garlic bread. Sharp teeth (and here I'm hinting at stactites and stalagmites) gnash (poetically speaking) at the lips of the cave. I think that's descriptive enough.",
+       { 'southwest': 'Fork in the road',
+         'north': 'Cave foyer',
+         'in': 'Cave foyer' })
 
 #-----------------------------------------------------------------------------#
 
-Room('Cave foyer',
-     "Immediately inside the entrance to the cave, it opens up to a vaulted entryway. The skeletal remains and equipment of what must be the world's absolute worst spelunker slump against one wall. Deeper into the cave, a low passage winds north.",
-     { 'out': 'Mouth of a cave',
-       'south': 'Mouth of a cave',
-       'north': 'Narrow passage' })
-pack = Item('backpack', 'Cave foyer', capacity=6)
-Item('pen', pack)
-Item('journal page', pack).write('August 13;;Down to my last stick of gum. I should have brought more food and less gum.;;The exit from this cave must be somewhere around here, but I lack the strength to keep looking.;;...')
+@section
+def cave_foyer():
+  Room('Cave foyer',
+       "Immediately inside the entrance to the cave, it opens up to a vaulted entryway. The skeletal remains and equipment of what must be the world's absolute worst spelunker slump against one wall. Deeper into the cave, a low passage winds north.",
+       { 'out': 'Mouth of a cave',
+         'south': 'Mouth of a cave',
+         'north': 'Narrow passage' })
+  pack = Item('backpack', 'Cave foyer', capacity=6)
+  Item('pen', pack)
+  Item('journal page', pack).write('August 13;;Down to my last stick of gum. I should have brought more food and less gum.;;The exit from this cave must be somewhere around here, but I lack the strength to keep looking.;;...')
 
 #-----------------------------------------------------------------------------#
 
-Room('Narrow passage',
-     "The passage soon becomes so low you have to belly crawl to get anywhere. It's also dark, very dark. The walls press your sides, unyielding cold stone. Despite the chill, sweat beads your brow. There is scuffling sound behind you. A footstep? No, no. You feel like you're suffocating. Is that a dim glow up ahead? Please let it be so...",
-     { 'south': 'Cave foyer',
-       'north': 'Chamber' });
+@section
+def narrow_passage():
+  Room('Narrow passage',
+       "The passage soon becomes so low you have to belly crawl to get anywhere. It's also dark, very dark. The walls press your sides, unyielding cold stone. Despite the chill, sweat beads your brow. There is scuffling sound behind you. A footstep? No, no. You feel like you're suffocating. Is that a dim glow up ahead? Please let it be so...",
+       { 'south': 'Cave foyer',
+         'north': 'Chamber' });
 
 #-----------------------------------------------------------------------------#
 
-Room('Chamber',
-     "Small fissures in the ceiling allow a bit of daylight to filter into this fairly roomy chamber. Passages extend in all four directions.",
-     { 'south': 'Narrow passage',
-       'north': 'North chamber',
-       'east': 'East chamber',
-       'west': 'West chamber' })
 class Robot(Entity):
+  __slots__ = ()
   def onHear(self, speech, source):
-    self.stack.append(source)
-    self.active = True
-    for line in speech.split(';'):
-      if not self.active:
-        break
-      say('>' * (len(self.stack)+1), line)
-      self.parse(line)
-    self.stack.pop()
-Robot('robot', 'Chamber',
-      "Picure Bender from Futurama, without the drinking problem. That's pretty much this robot. Not that he's without his problems though; his problem is overenthusiasm.").name = 'Floyd'
+    heard = SPEECHES.get(speech)
+    if not heard:
+      if len(SPEECHES) > CACHED:
+        SPEECHES.clear()
+      heard = SPEECHES[speech] = (speech.split(';'), Procedure())
+    frame = Frame(heard[0], heard[1], self)
+    if PROFILE:
+      frame.label = '%s told "%s"' % (self.name or self, speech)
+    self.follow(frame)
+@section
+def chamber():
+  Room('Chamber',
+       "Small fissures in the ceiling allow a bit of daylight to filter into this fairly roomy chamber. Passages extend in all four directions.",
+       { 'south': 'Narrow passage',
+         'north': 'North chamber',
+         'east': 'East chamber',
+         'west': 'West chamber' })
+  Robot('robot', 'Chamber',
+        "Picure Bender from Futurama, without the drinking problem. That's pretty much this robot. Not that he's without his problems though; his problem is overenthusiasm.").name = 'Floyd'
 
 #-----------------------------------------------------------------------------#
 
-Room('West chamber',
-     "I haven't decided what this room looks like. Come back later.",
-     { 'east': 'Chamber' })
+@section
+def west_chamber():
+  Room('West chamber',
+       "I haven't decided what this room looks like. Come back later.",
+       { 'east': 'Chamber' })
 
 #-----------------------------------------------------------------------------#
 
-Room('East chamber',
-     "A single shaft of daylight penetrates the gloom, shining from a small hole in the middle of the high ceiling of this subterranean chamber. A large cauldron stands directly beneath the hole. There are openings to the west and southeast.",
-     { 'west': 'Chamber',
-       'southeast': 'Hall of justice' })
-cauldron = Furniture('blackened cauldron', 'East chamber',
-                     "The cauldron is coated with sooty blackness.")
+@section
+def east_chamber():
+  Room('East chamber',
+       "A single shaft of daylight penetrates the gloom, shining from a small hole in the middle of the high ceiling of this subterranean chamber. A large cauldron stands directly beneath the hole. There are openings to the west and southeast.",
+       { 'west': 'Chamber',
+         'southeast': 'Hall of justice' })
+  LANDMARKS['cauldron'] = Furniture('blackened cauldron', 'East chamber',
+                                    "The cauldron is coated with sooty blackness.")
 
 #-----------------------------------------------------------------------------#
 
-class HallOfJustice(Room):
-  def onTick(self):
-    balance.weigh()
-HallOfJustice('Hall of justice',
-              "In contrast with the natural caves nearby, this room seems to have been carved from the living stone, which, as it happens, is a pure white marble. Upon a stone dias in the middle of the room is a classical statue of a blindfolded woman. From her outstretched right hand dangles a golden balance scale. Her left arm is bent at the elbow and her middle finger is held upright, forever fixed in some ancient gesture whose meaning is now long lost.\nThe only exit is to the northwest.",
-              { 'northwest': 'East chamber' })
 class Balance(Furniture):
+  # Reweighs as soon as something's put in a pan, and again whenever what's
+  # in the pans gets heavier or lighter
+  __slots__ = ()
+  WATCH = ('weight',)
   def onTake(self, item, source):
     self.weigh()
+  def onChange(self, events):
+    self.weigh()
   def weigh(self):
     if len(self.items) == 2:
-      w1,w2 = [item.weight() for item in self.items]
-      if w2 > w1:
+      first, second = self.items
+      if heavier(second, first):
         self.items.reverse()
+        if TRACE:
+          TRACE.change(Trace.REVERSE, self)
         say('The far side of the', self, 'occupied by the', self.items[0],
             'rotates forwards.')
-balance = Balance('balance scale', 'Hall of justice',
-        "This ornate golden scale appears to be fully functional. It operates on a swivel so that the heavier item placed in it's two weighing pans will rotate to the front.",
-        capacity=2)
+def heavier(a, b):
+  # Whether a weighs more than b. Unless either's infinite, the difference
+  # is worked out in ints, over the product of the denominators, rather than
+  # by adding and comparing Fractions.
+  x, y = (a.qty or 0) + a.load, (b.qty or 0) + b.load
+  f, g = a.fraction, b.fraction
+  if not (f or g) or type(x) is float or type(y) is float:
+    return x + f > y + g
+  d = x - y
+  if not g:
+    return d * f.denominator + f.numerator > 0
+  if not f:
+    return d * g.denominator - g.numerator > 0
+  return (d.numerator * f.denominator * g.denominator +
+          f.numerator * d.denominator * g.denominator -
+          g.numerator * d.denominator * f.denominator) > 0
+
+@section
+def hall_of_justice():
+  Room('Hall of justice',
+       "In contrast with the natural caves nearby, this room seems to have been carved from the living stone, which, as it happens, is a pure white marble. Upon a stone dias in the middle of the room is a classical statue of a blindfolded woman. From her outstretched right hand dangles a golden balance scale. Her left arm is bent at the elbow and her middle finger is held upright, forever fixed in some ancient gesture whose meaning is now long lost.\nThe only exit is to the northwest.",
+       { 'northwest': 'East chamber' })
+  LANDMARKS['balance'] = Balance('balance scale', 'Hall of justice',
+          "This ornate golden scale appears to be fully functional. It operates on a swivel so that the heavier item placed in it's two weighing pans will rotate to the front.",
+          capacity=2)
 
 #-----------------------------------------------------------------------------#
 
-Room('North chamber',
-     "The rough, natural passage entering this chamber from the south, not to mention the craggy subterranean setting in general, contrast sharply with the professional glass and steel facade to the north. The design work is modern and impeccable. Lettered over the door in 900pt Helvetica are the words:\n  Calloway, Papermaster, Turban and Hoyt LLC\n               Attorneys at Law",
-     { 'south': 'Chamber',
-       'north': 'Reception' })
+@section
+def north_chamber():
+  Room('North chamber',
+       "The rough, natural passage entering this chamber from the south, not to mention the craggy subterranean setting in general, contrast sharply with the professional glass and steel facade to the north. The design work is modern and impeccable. Lettered over the door in 900pt Helvetica are the words:\n  Calloway, Papermaster, Turban and Hoyt LLC\n               Attorneys at Law",
+       { 'south': 'Chamber',
+         'north': 'Reception' })
 
 #-----------------------------------------------------------------------------#
 
-Room('Reception',
-     "The room's centerpiece is an all-glass desk providing a clear view of the receptionist's knees, were there a receptionist present. Convenient to the desk is a document shredder.\nThe office exit is to the south, a doorway to a small room lies east and a hallway stretches to the north.",
-     { 'south': 'North chamber',
-       'north': 'Hallway',
-       'east': 'Supply closet' })
 class Shredder(Furniture):
+  __slots__ = ()
   def onTake(self, item, source):
     if item.type == 'parchment' and len(item.writing) > 1:
       item.move(None)
       for shred in item.writing:
         Item('shredded parchment', self).write(shred)
-      say('The', item, 'is shredded into', str(len(item.writing)), 'strips.')
-Shredder('shredder', 'Reception', 'Model 8678b Vellum Shredder. "For When You\'ve Got Something to Hide". (You may have missed it, but that was a pun, just there.)')
+      say('The', item, 'is shredded into', len(item.writing), 'strips.')
+@section
+def reception():
+  Room('Reception',
+       "The room's centerpiece is an all-glass desk providing a clear view of the receptionist's knees, were there a receptionist present. Convenient to the desk is a document shredder.\nThe office exit is to the south, a doorway to a small room lies east and a hallway stretches to the north.",
+       { 'south': 'North chamber',
+         'north': 'Hallway',
+         'east': 'Supply closet' })
+  Shredder('shredder', 'Reception', 'Model 8678b Vellum Shredder. "For When You\'ve Got Something to Hide". (You may have missed it, but that was a pun, just there.)')
 
 #-----------------------------------------------------------------------------#
 
-Room('Hallway',
-     "The hallway runs north-south. The walls are decorated with motivational posters and inexpertly-executed watercolors. There are doors on either side.",
-     { 'south': 'Reception',
-       'north': 'More hallway',
-       'east': 'Bathroom',
-       'west': 'Executive office' })
+@section
+def hallway():
+  Room('Hallway',
+       "The hallway runs north-south. The walls are decorated with motivational posters and inexpertly-executed watercolors. There are doors on either side.",
+       { 'south': 'Reception',
+         'north': 'More hallway',
+         'east': 'Bathroom',
+         'west': 'Executive office' })
 
 #-----------------------------------------------------------------------------#
 
-Room('Executive office',
-     "Though not a corner office, this roomy office is well appointed with mahogony panelling and a large picture window with an expansive view of a solid rock wall a few inches away. There's an impressive desk and commodious filing cabinet, and on the wall an original painting which, while abstract, manages to suggest a phallus pretty clearly.",
-     { 'east': 'Hallway' })
-Furniture('oak desk', 'Executive office',
-          "An oppressively impressive oak desk. Under the front edge you notice a red button.")
-fc = Furniture('filing cabinet', 'Executive office',
-               "A tall filing cabinet in dark wood.",
-               capacity=40, closed=True)
-ff = Item('file folder', fc, capacity=24)
-ff.write("Turban, Edward G.")
-Item('personnel parchment', ff).write("PERSONNEL REPORT;Edward G. Turban;;  ...Mr. Turban shows antisocial tendencies...tends to act like a dick...often late to work...;;- Harold Papermaster""")
+@section
+def executive_office():
+  Room('Executive office',
+       "Though not a corner office, this roomy office is well appointed with mahogony panelling and a large picture window with an expansive view of a solid rock wall a few inches away. There's an impressive desk and commodious filing cabinet, and on the wall an original painting which, while abstract, manages to suggest a phallus pretty clearly.",
+       { 'east': 'Hallway' })
+  Furniture('oak desk', 'Executive office',
+            "An oppressively impressive oak desk. Under the front edge you notice a red button.")
+  fc = Furniture('filing cabinet', 'Executive office',
+                 "A tall filing cabinet in dark wood.",
+                 capacity=40, closed=True)
+  ff = Item('file folder', fc, capacity=24)
+  ff.write("Turban, Edward G.")
+  Item('personnel parchment', ff).write("PERSONNEL REPORT;Edward G. Turban;;  ...Mr. Turban shows antisocial tendencies...tends to act like a dick...often late to work...;;- Harold Papermaster""")
 
 #-----------------------------------------------------------------------------#
 
-Room('Bathroom',
-     "The bathroom is equipped with the usual fixtures. In the floor, there is a large drain.",
-     { 'west': 'Hallway',
-       'out': 'Hallway' })
 class StandardOut(Furniture):
+  __slots__ = ()
   def onTake(self, item, source):
     for item in self.items:
       output(item.writing)
       say('The', item, 'vanishes into the drain.')
       item.move(None)
-StandardOut('drain pipe', 'Bathroom',
-            "The drain sits at the low point of the tiled floor. It is emblazoned with the words \"STANDARD PIPE CO.\".")
+@section
+def bathroom():
+  Room('Bathroom',
+       "The bathroom is equipped with the usual fixtures. In the floor, there is a large drain.",
+       { 'west': 'Hallway',
+         'out': 'Hallway' })
+  StandardOut('drain pipe', 'Bathroom',
+              "The drain sits at the low point of the tiled floor. It is emblazoned with the words \"STANDARD PIPE CO.\".")
 
 #-----------------------------------------------------------------------------#
 
-mailroom = Room('Supply closet',
-                "One too many employees swiped supplies from here and the last binder clip went to someone's home long ago, so the shelves are basically bare. On one shelf, there is a postal scale.",
-                { 'west': 'Reception' })
 class Scale(Furniture):
+  __slots__ = ()
   def onTake(self, item, source):
-    wt = str(self.weight())
-    if wt[-2:] == '.0': wt = wt[:-2]  # remove .0 if integral
-    self.writing = [wt]
-scale = Scale('postal scale', mailroom,
-              'The postal scale features a digital readout and a bold red button.')
+    self.writing = [amount(self.weight())]
 class ScaleButton(Furniture):
+  __slots__ = ()
   def onPush(self):
+    scale = LANDMARKS['scale']
     label = Item('metering label', scale)
     label.write('\n'.join(scale.writing))
     label.name = scale.writing[0];
-    say("Skrzzzzzzztkrrrrrzt... ", Cap(label.describe(True)), 'emerges.')
-ScaleButton('red button', mailroom, "It's an inviting red button ergonomically positioned on the postal scale.")
+    say("Skrzzzzzzztkrrrrrzt... ", Later(lambda: Cap(label.describe(True))), 'emerges.')
+@section
+def supply_closet():
+  mailroom = Room('Supply closet',
+                  "One too many employees swiped supplies from here and the last binder clip went to someone's home long ago, so the shelves are basically bare. On one shelf, there is a postal scale.",
+                  { 'west': 'Reception' })
+  LANDMARKS['scale'] = Scale('postal scale', mailroom,
+                             'The postal scale features a digital readout and a bold red button.')
+  ScaleButton('red button', mailroom, "It's an inviting red button ergonomically positioned on the postal scale.")
 
 #-----------------------------------------------------------------------------#
 
-Room('More hallway',
-     "The hallway from the south ends at a door to the north, and there are doors to the east and west as well.",
-     { 'south': 'Hallway',
-       'north': 'Stairs - Ground floor',
-       'west': 'Kitchen',
-       'east': 'Cubicles' })
+@section
+def more_hallway():
+  Room('More hallway',
+       "The hallway from the south ends at a door to the north, and there are doors to the east and west as well.",
+       { 'south': 'Hallway',
+         'north': 'Stairs - Ground floor',
+         'west': 'Kitchen',
+         'east': 'Cubicles' })
 
 #-----------------------------------------------------------------------------#
 
@@ -936,75 +1887,417 @@ def floorname(floor):
     return 'Stairs - Ground floor'
   else:
     return 'Stairs - Floor ' + ordinal(floor)
+def stairs(name):
+  # The floor of the staircase called name, made afresh, if it is one
+  if name == floorname(0):
+    return Stairs(0)
+  if name.startswith('Stairs - Floor '):
+    number = name[len('Stairs - Floor '):]
+    try:
+      floor = -int(number[1:]) if number[:1] == 'P' else int(number)
+    except ValueError:
+      return None
+    if floorname(floor) == name:
+      return Stairs(floor)
+  return None
 class Stairs(Room):
+  # Floors are made as they're entered, and forgotten again once there's
+  # nothing left on them but their wall as it was. The ground floor, whose
+  # exits are its own, is always kept.
+  __slots__ = ('floor',)
   def __init__(self, floor):
     exits = { 'down': floorname(floor-1),
               'up':   floorname(floor+1) }
     Room.__init__(self, floorname(floor),
                   "You stand on an echo-y staircase landing. One white-painted, industrial flight spirals upwards, and another leads down. Your level within the building is painted on the wall.",
                   exits)
+    self.exits = exits  # By name, so a forgotten floor isn't kept around
     self.floor = floor
     Furniture('wall', self).write(ordinal(floor))
-    
-  def onTake(self, whom, source):
-    if whom.type == 'You':
-      if floorname(self.floor-1) not in ROOMS:
-        Stairs(self.floor-1)
-      if floorname(self.floor+1) not in ROOMS:
-        Stairs(self.floor+1)
 
-Stairs(0).exits['south'] = 'More hallway'
-       
+  def onLeave(self, item):
+    if self.floor and len(self.items) == 1:
+      wall = self.items[0]
+      if (wall.noun == 'wall' and not wall.adjective and not wall.name and
+          not wall.items and wall.writing == [ordinal(self.floor)]):
+        ROOMS.pop(self.name, None)
+        if TRACE:
+          TRACE.change(Trace.FORGET, None, self.name)
+@section
+def staircase():
+  Stairs(0).exits['south'] = 'More hallway'
+
 #-----------------------------------------------------------------------------#
 
-Room('Roof',
-     "The wind tosses your silky adventurer's hairstyle as you gaze upon the landscape. The world is your oyster, judging by the smell. Or maybe that's the pidgeon coop.",
-     { 'down': 'Stairs - Floor 2' })
-coop = Furniture('coop', 'Roof')
+class Printout(object):
+  # The lines of a file, as readlines() would have them, read through a
+  # memory map as they're wanted rather than all at once. The offset of
+  # every STRIDE-th line is noted as the file's read, so any line can be
+  # found again without reading from the top.
+  STRIDE = 1024
+  CHUNK = 1 << 20  # Bytes to read at a time when going through the lot
+
+  def __init__(self, filename):
+    self.filename = filename
+    f = open(filename, 'rb')
+    if os.fstat(f.fileno()).st_size:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      self.data = ''
+    f.close()
+    self.marks = [0]  # Offsets of lines 0, STRIDE, 2*STRIDE...
+    self.line = self.offset = 0  # The line after the last one read
+    self.count = None
+
+  def __reduce__(self):
+    return (fetch, (self.filename,))
+
+  def __len__(self):
+    if self.count is None:
+      data = self.data
+      self.count = sum([data[start:start + self.CHUNK].count('\n')
+                        for start in xrange(0, len(data), self.CHUNK)])
+      if data[-1:] not in ('', '\n'):
+        self.count += 1
+    return self.count
+
+  def __nonzero__(self):
+    return len(self.data) > 0
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    data = self.data
+    mark = min(i // self.STRIDE, len(self.marks) - 1)
+    if mark * self.STRIDE < self.line <= i:
+      line, offset = self.line, self.offset
+    else:
+      line, offset = mark * self.STRIDE, self.marks[mark]
+    while True:
+      if i < 0 or offset >= len(data):
+        raise IndexError('printout line out of range')
+      if not line % self.STRIDE and line // self.STRIDE == len(self.marks):
+        self.marks.append(offset)
+      end = data.find('\n', offset) + 1 or len(data)
+      if line == i:
+        break
+      line, offset = line + 1, end
+    self.line, self.offset = line + 1, end
+    return data[offset:end]
+
+  def __iter__(self):
+    data = self.data
+    offset = 0
+    while offset < len(data):
+      end = data.find('\n', offset) + 1 or len(data)
+      yield data[offset:end]
+      offset = end
+
+  def __add__(self, lines):
+    return list(self) + lines
+
+  def output(self, out, raw=False):
+    # Writes the lines as output() would, a chunk at a time, or if raw
+    # just as they are
+    data = self.data
+    for start in xrange(0, len(data), self.CHUNK):
+      if raw:
+        out.write(data[start:start + self.CHUNK])
+      else:
+        out.write(data[start:start + self.CHUNK].replace('\n', '\n\n'))
+    if data[-1:] != '\n' and not raw:
+      out.write('\n')
+
+FETCHED = collections.OrderedDict()  # Mapping from (path, mtime, size) to
+                                     # printout, least recently used first
+FETCH_LIMIT = 1 << 28  # Bytes of fetched files to keep, in each world
+FETCH_LOCK = threading.Lock()  # Held while a world's FETCHED is changed
+PREFETCH = False  # Whether to start fetching files named on the roof
+FILES = True  # Whether the pidgeon may fetch files from this host at all
+
+def fetch(filename, fetched=None):
+  # A printout of the file, shared with every other fetch of it since it
+  # last changed, kept in fetched, or the running world's FETCHED
+  if fetched is None:
+    fetched = FETCHED
+  info = os.stat(filename)
+  key = (os.path.abspath(filename), info.st_mtime, info.st_size)
+  with FETCH_LOCK:
+    printout = fetched.pop(key, None)
+    if printout:
+      fetched[key] = printout
+      return printout
+  printout = Printout(filename)
+  with FETCH_LOCK:
+    printout = fetched.setdefault(key, printout)
+    size = sum([size for (path, mtime, size) in fetched])
+    while size > FETCH_LIMIT and len(fetched) > 1:
+      (path, mtime, oldest), _ = fetched.popitem(last=False)
+      size -= oldest
+  return printout
+
+def prefetch(filename):
+  # Fetches and counts the lines of the file in the background, so it's
+  # ready when the pidgeon's sent for it. The thread doesn't hold the
+  # world, so it's given the world's FETCHED to keep it in.
+  fetched = FETCHED
+  def fetching():
+    try:
+      len(fetch(filename, fetched))
+    except EnvironmentError:
+      pass
+  thread = threading.Thread(target=fetching)
+  thread.daemon = True
+  thread.start()
+
 class Pidgeon(Item):
+  __slots__ = ()
   def onTake(self, note, source):
     if note.type != 'parchment':
       say("You cant attach that to a pidgeon.")
+    elif not FILES:
+      say("The", self, "eyes the", note, "and declines to fly anywhere.")
     else:
-      printout = Item('printout', coop)
-      printout.writing = open(note.writing[0], 'rt').readlines()
-      printout.adjective = "%d-page" % (len(printout.writing) / 35 + 1)
+      printout = Item('printout', None)
+      printout.writing = fetch(note.writing[0])
+      alter(printout, 'adjective',
+            "%d-page" % (len(printout.writing) / 35 + 1))
       printout.name = note.writing[0].split('.')[0]
-      say("You tie the %s to the pidgeon's leg. Suddenly instilled with a sense of purpose, the pidgeon flies off, only to return a minute or two later with a %s in it's beak. It drops the %s inside the coop." % (note, printout, printout.noun))
-Pidgeon('carrier pidgeon', coop, capacity=1)
+      printout.move(LANDMARKS['coop'])
+      say(Later("You tie the %s to the pidgeon's leg. Suddenly instilled with a sense of purpose, the pidgeon flies off, only to return a minute or two later with a %s in it's beak. It drops the %s inside the coop.", note, printout, printout.noun))
+@section
+def roof():
+  Room('Roof',
+       "The wind tosses your silky adventurer's hairstyle as you gaze upon the landscape. The world is your oyster, judging by the smell. Or maybe that's the pidgeon coop.",
+       { 'down': 'Stairs - Floor 2' })
+  LANDMARKS['coop'] = Furniture('coop', 'Roof')
+  Pidgeon('carrier pidgeon', LANDMARKS['coop'], capacity=1)
 
 #-----------------------------------------------------------------------------#
 
-Room('Cubicles',
-     "You are in a maze of cubibles, all alike.",
-     { 'north': 'Cubicles',
-       'south': 'Cubicles',
-       'east': 'Cubicles',
-       'west': 'Cubicles' })
+@section
+def cubicles():
+  Room('Cubicles',
+       "You are in a maze of cubibles, all alike.",
+       { 'north': 'Cubicles',
+         'south': 'Cubicles',
+         'east': 'Cubicles',
+         'west': 'Cubicles' })
 
 #-----------------------------------------------------------------------------#
 
-Room('Kitchen',
-     "You stand in a small kitchen and break room. There's a sink and a cupboard and a toaster oven, and a motivational poster on the wall with a picture of a kitten and the words 'GET BACK TO WORK'.",
-     { 'east': 'More hallway' })
-cupboard = Furniture('cupboard', 'Kitchen',
-                     "Just a cupboard.",
-                     capacity=float('inf'),
-                     closed=True)
 class Pan(Item):
+  # Holds exactly as much dirt as its capacity, a float, comes to
+  __slots__ = ()
   def onTake(self, item, source):
     if item.type != 'dirt':
       item.move(source)
       return say('You cant put the', item, 'there.')
-    elif self.items:
-      excess = self.items[0].qty - self.capacity
-      if excess > 0:
-        say('The', self, 'is chock full.')
-        Item('dirt', source).qty = excess
-        self.items[0].qty = self.capacity
-Pan('pie tin', cupboard, "A circular pie tin, suitable for pies.",
-    capacity=math.pi)
-Pan('cake pan', cupboard, "A square cake pan.", capacity=math.sqrt(2))
+    elif self.items and self.items[0].qty > self.capacity:
+      import fractions
+      capacity = fractions.Fraction(self.capacity)
+      say('The', self, 'is chock full.')
+      Item('dirt', source).qty = self.items[0].qty - capacity
+      self.items[0].qty = capacity
+@section
+def kitchen():
+  Room('Kitchen',
+       "You stand in a small kitchen and break room. There's a sink and a cupboard and a toaster oven, and a motivational poster on the wall with a picture of a kitten and the words 'GET BACK TO WORK'.",
+       { 'east': 'More hallway' })
+  cupboard = Furniture('cupboard', 'Kitchen',
+                       "Just a cupboard.",
+                       capacity=float('inf'),
+                       closed=True)
+  Pan('pie tin', cupboard, "A circular pie tin, suitable for pies.",
+      capacity=math.pi)
+  Pan('cake pan', cupboard, "A square cake pan.",
+      capacity=math.sqrt(2))
+
+#=============================================================================#
+
+def build():
+  for part in SECTIONS:
+    part()
+
+
+SOURCE = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+SNAPSHOT = os.path.splitext(SOURCE)[0] + '.' + __name__ + '.world'
+
+def snapshot(filename=SNAPSHOT):
+  # The world as built, pickled. It's read from filename if that was taken
+  # of this very source and is whole; otherwise the world is built and a
+  # snapshot saved there
+  import hashlib
+  try:
+    info = os.stat(SOURCE)
+    stamp = (__name__, info.st_mtime, info.st_size, sys.version)
+  except OSError:
+    stamp = None
+  try:
+    f = open(filename, 'rb')
+    if stamp and cPickle.load(f) == stamp:
+      digest = cPickle.load(f)
+      pickled = f.read()
+      if hashlib.sha1(pickled).digest() == digest:
+        return pickled
+  except Exception:
+    pass  # Missing, truncated or corrupt: build it again
+  build()
+  pickled = cPickle.dumps(dict([(name, globals()[name])
+                                for name in World.BUILT]), 2)
+  if stamp:
+    temporary = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+      f = open(temporary, 'wb')
+      cPickle.dump(stamp, f, 2)
+      cPickle.dump(hashlib.sha1(pickled).digest(), f, 2)
+      f.write(pickled)
+      f.close()
+      os.rename(temporary, filename)
+    except (IOError, OSError):
+      try:
+        os.remove(temporary)
+      except OSError:
+        pass
+  return pickled
+
+
+LOCK = threading.RLock()  # Held by whoever's running a world
+RUNNING = None  # The world whose state is in the module globals
+
+class World(object):
+  # Everything that makes up a world: its rooms and their contents, the
+  # words they've taught the parser, its statistics, where its feedback and
+  # output go, the files it's fetched and how it's set to run. There's only
+  # the one set of module globals of those names, and they belong to
+  # whichever world is running: "with world:" saves that world's state from
+  # them, puts this one's in, and holds LOCK until it's done. So only one
+  # world runs at a time, in any thread, and the rest wait their turn.
+  BUILT = ['ROOMS', 'DIRECTIONS', 'NOUNS', 'ADJECTIVES', 'NAMES', 'KINDS',
+           'LANDMARKS', 'STATS']
+  SETTINGS = ['MAX_DEPTH', 'PREFETCH']  # As the world it's made in has them
+  STATE = BUILT + SETTINGS + ['PARSED', 'EPOCH', 'SPEECHES', 'CHANGED',
+                              'BUSY', 'TRACE', 'CHECKPOINT', 'FEEDBACK',
+                              'OUTPUT', 'FILES', 'FETCHED']
+
+  def __init__(self, pristine=None):
+    self.pristine = pristine or PRISTINE
+    self.outer = []  # Worlds this one was run from
+    self.reset()
+
+  def reset(self):
+    # Puts the world back the way it was built, set to run like the world
+    # that's running
+    self.state = cPickle.loads(self.pristine)
+    self.state.update([(name, globals()[name]) for name in self.SETTINGS])
+    self.state.update(PARSED=set(), EPOCH=0, SPEECHES={},
+                      CHANGED=[],
+                      BUSY=collections.deque(), TRACE=None,
+                      CHECKPOINT=None, FEEDBACK=None, OUTPUT=None,
+                      FILES=True, FETCHED=collections.OrderedDict())
+    if RUNNING is self:
+      globals().update(self.state)
+
+  def save(self):
+    self.state = dict([(name, globals()[name]) for name in self.STATE])
+
+  def __enter__(self):
+    global RUNNING
+    LOCK.acquire()
+    self.outer.append(RUNNING)
+    if RUNNING is not self:
+      RUNNING.save()
+      globals().update(self.state)
+      RUNNING = self
+    return self
+
+  def __exit__(self, *exc):
+    global RUNNING
+    outer = self.outer.pop()
+    if outer is not self:
+      self.save()
+      globals().update(outer.state)
+      RUNNING = outer
+    LOCK.release()
+
+PRISTINE = snapshot()
+WORLD = RUNNING = World()  # The world the command line runs
+globals().update(WORLD.state)
+
+
+class Session(object):
+  # A player in a world of their own, whose output is kept rather than
+  # printed. Feedback meant for stdout is kept along with it. Unless files,
+  # the pidgeon won't fetch files from this host.
+  def __init__(self, params=(), feedback=None, files=True):
+    self.stdout = cStringIO.StringIO()
+    if feedback is sys.stdout:
+      feedback = self.stdout
+    self.world = World()
+    self.world.state.update(FEEDBACK=feedback, OUTPUT=self.stdout,
+                            FILES=files)
+    self.pending = collections.deque()  # Lines told but not yet followed
+    self.spent = 0.0  # Seconds spent running the session, world in hand
+    with self.world:
+      self.player = start(params)
+
+  def run(self, lines):
+    # Has the player follow lines, a SLICE of commands at a time, so the
+    # world's let go between slices for other threads' sessions to run;
+    # returns the lines output and the world's statistics
+    self.pending.extend(lines)
+    while self.step(SLICE):
+      pass
+    with self.world:
+      stats = dict(STATS)
+    return self.read(), stats
+
+  def tell(self, line):
+    self.pending.append(line)
+
+  def step(self, budget):
+    # Follows at most budget commands, from the lines told and the orders
+    # they set, by whoever's been given them; returns whether there's more
+    # to follow. The next line told waits until all the orders are done.
+    # The time taken is charged to the session from when it has the world,
+    # not while it waits for others, and as only one world runs at a time,
+    # that's the time spent on it and no other.
+    player = self.player
+    with self.world:
+      began = time.time()
+      try:
+        while budget and player.active:
+          if BUSY:
+            budget = turns(budget)
+          elif self.pending:
+            budget -= 1
+            line = self.pending.popleft()
+            if TRACE:
+              TRACE.command(player, line)
+            STATS['commands'] += 1
+            player.parse(line)
+          else:
+            break
+        busy = bool(BUSY)
+      finally:
+        self.spent += time.time() - began
+    return bool(player.active and (busy or self.pending))
+
+  def drain(self):
+    # What's been output since the last drain
+    text = self.stdout.getvalue()
+    self.stdout.truncate(0)
+    return text
+
+  def read(self):
+    # The lines output since the last read
+    return self.drain().splitlines()
+
+
+def run(lines, params=()):
+  # Runs lines in a world of their own; returns the lines output and the
+  # world's statistics
+  return Session(params).run(lines)
 
 #=============================================================================#
 
@@ -1017,16 +2310,488 @@ def Cap(s):
   return s[:1].upper() + s[1:]
 
 
-FEEDBACK = None
+FEEDBACK = None  # Where narration goes, if anywhere
+OUTPUT = None  # Where output goes, if not stdout
+
+
+class Later(object):
+  # Narration that's only put together if it's going to be said: either a
+  # format string and its arguments, or a function to call for the text
+  def __init__(self, how, *args):
+    self.how = how
+    self.args = args
+
+  def __str__(self):
+    if callable(self.how):
+      return self.how(*self.args)
+    return self.how % self.args
+
+
+def listed(item):
+  return '  ' + Cap(item.describe(True)) + '.'
+
 
+WRAPPED = {}  # Lines of feedback as wrapped to be said, by line, in any world
 
 def say(*args):
   if FEEDBACK:
-    for s in Cap(' '.join([str(a) for a in args])).split('\n'):
-      FEEDBACK.write(textwrap.fill(s) + '\n')
+    lines = Cap(' '.join([str(a) for a in args])).split('\n')
+    for i, line in enumerate(lines):
+      wrapped = WRAPPED.get(line)
+      if wrapped is None:
+        if len(WRAPPED) > 10000:
+          WRAPPED.clear()
+        import textwrap
+        wrapped = WRAPPED[line] = textwrap.fill(line) + '\n'
+      lines[i] = wrapped
+    FEEDBACK.write(''.join(lines))
 
 def output(lines):
-  print '\n'.join(lines)
+  if TRACE:
+    TRACE.change(Trace.OUTPUT, None, lines)
+  if isinstance(OUTPUT, Sink):
+    OUTPUT.page(lines)
+  elif isinstance(lines, Printout):
+    lines.output(OUTPUT or sys.stdout)
+  else:
+    (OUTPUT or sys.stdout).write('\n'.join(lines) + '\n')
+
+WRITING = False  # Whether a sink's part way through writing out
+TERMINATED = None  # The status to exit with once it's done, if terminated
+
+class Sink(object):
+  # Where output goes from the command line: a file descriptor, written
+  # a buffer's worth at a time, or whenever a write, or a tick between
+  # turns, finds interval seconds have passed since the last. Raw pages
+  # are written as their lines run together, without a newline between or
+  # after them.
+  def __init__(self, fd=1, buffer=1 << 16, interval=None, raw=False):
+    self.fd = fd
+    self.buffer = buffer
+    self.interval = interval
+    self.raw = raw
+    self.parts = []
+    self.size = 0
+    self.flushed = time.time()
+
+  def page(self, lines):
+    if isinstance(lines, Printout):
+      lines.output(self, self.raw)
+    elif self.raw:
+      for line in lines:
+        self.write(line)
+    else:
+      self.write('\n'.join(lines) + '\n')
+
+  def write(self, text):
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+    self.parts.append(text)
+    self.size += len(text)
+    if self.size >= self.buffer:
+      self.flush()
+    else:
+      self.tick()
+
+  def tick(self):
+    # Writes out what's buffered if it's been interval seconds
+    if (self.parts and self.interval is not None and
+        time.time() - self.flushed >= self.interval):
+      self.flush()
+
+  def flush(self):
+    # Should the run be terminated while this is writing out, it finishes
+    # first, and then exits
+    global WRITING, TERMINATED
+    WRITING = True
+    try:
+      data = ''.join(self.parts)
+      self.parts = []
+      self.size = 0
+      self.flushed = time.time()
+      while data:
+        data = data[os.write(self.fd, data):]
+    finally:
+      WRITING = False
+    if TERMINATED:
+      status, TERMINATED = TERMINATED, None
+      sys.exit(status)
+
+  def tell(self):
+    # How far into the file output's got, once flushed; None if it's not
+    # going to a file
+    self.flush()
+    if stat.S_ISREG(os.fstat(self.fd).st_mode):
+      return os.lseek(self.fd, 0, os.SEEK_CUR)
+
+  def rewind(self, offset):
+    # Cuts the file back to offset, dropping what was output after it
+    if (offset is not None and stat.S_ISREG(os.fstat(self.fd).st_mode) and
+        os.fstat(self.fd).st_size >= offset):
+      os.ftruncate(self.fd, offset)
+      os.lseek(self.fd, offset, os.SEEK_SET)
+
+
+def due():
+  # Has buffered output and feedback written out once they've waited long
+  # enough, even if nothing's been written since, and what's been traced
+  # written out. It's called between turns, so a run that's gone quiet
+  # still keeps to -I.
+  for sink in OUTPUT, FEEDBACK:
+    if isinstance(sink, Sink):
+      sink.tick()
+  if TRACE and TRACE.parts:
+    TRACE.flush()
+
+
+PROFILE = None  # The command line's profile, of whatever world's running
+
+class Profile(object):
+  # Time spent and items made, by the path of lines being run (-P)
+  def __init__(self):
+    self.paths = {}  # Mapping from path to [hits, seconds, items]
+    self.text = {}  # Mapping from line location to the line itself
+    self.running = []  # [path, start, items, seconds and items inside]
+
+  def path(self):
+    return self.running and self.running[-1][0] or ()
+
+  def begin(self, path, line):
+    self.text.setdefault(path[-1], line.strip())
+    self.running.append([path, time.time(), STATS['items'], 0.0, 0])
+
+  def end(self):
+    path, start, items, inner, inneritems = self.running.pop()
+    elapsed = time.time() - start
+    made = STATS['items'] - items
+    tally = self.paths.get(path)
+    if not tally:
+      tally = self.paths[path] = [0, 0.0, 0]
+    tally[0] += 1
+    tally[1] += elapsed - inner
+    tally[2] += made - inneritems
+    if self.running:
+      self.running[-1][3] += elapsed
+      self.running[-1][4] += made
+
+  def report(self, out):
+    lines = {}  # Mapping from line to [hits, own seconds, seconds, items]
+    for path, (hits, seconds, items) in self.paths.items():
+      for where in set(path):
+        tally = lines.setdefault(where, [0, 0.0, 0.0, 0])
+        tally[2] += seconds
+        tally[3] += items
+      tally = lines[path[-1]]
+      tally[0] += hits
+      tally[1] += seconds
+    out.write('%9s %10s %10s %9s  %s\n' %
+              ('hits', 'own s', 'total s', 'items', 'line'))
+    for where, (hits, own, total, items) in sorted(lines.items(),
+                                                   key=lambda l: -l[1][2]):
+      out.write('%9d %10.4f %10.4f %9d  %s  %s\n' %
+                (hits, own, total, items, where, self.text[where]))
+    out.write('\n%9s %10s %9s  %s\n' % ('hits', 'own s', 'items', 'path'))
+    for path, (hits, seconds, items) in sorted(self.paths.items(),
+                                               key=lambda p: -p[1][1])[:20]:
+      out.write('%9d %10.4f %9d  %s\n' %
+                (hits, seconds, items, ' > '.join(path)))
+
+  def collapse(self, out):
+    # Stacks in the format flame graph tools take, weighted in microseconds
+    for path, (hits, seconds, items) in sorted(self.paths.items()):
+      out.write('%s %d\n' % (';'.join([where.replace(';', ',')
+                                        for where in path]),
+                              seconds * 1e6))
+
+
+def everything():
+  # Every room and everything in it, in an order that's kept when they're
+  # pickled
+  for name in sorted(ROOMS):
+    things = [ROOMS[name]]
+    while things:
+      thing = things.pop()
+      yield thing
+      things.extend(reversed(list(thing.items)))
+
+class Trace(object):
+  # A record of a run, for replay() to put the world back as it was at any
+  # step without following any commands: each command followed and every
+  # change it made, appended to filename as they happen. Each record is a
+  # kind, the number of the thing changed and the size of what follows,
+  # packed as RECORD, then that many bytes: usually the new value,
+  # marshalled, or pickled if it can't be (a pickle starts with \x80,
+  # which nothing marshalled does). Things are numbered as they turn up,
+  # the first time with a NEW record of what they're like, less what every
+  # new thing's like (FRESH). Now and then, once the changes recorded
+  # outweigh it SPACING times over, the whole world is pickled as a
+  # CHECKPOINT to start from, numbered by step, and everything in it
+  # numbered afresh. Records are kept in memory and written out together
+  # between turns.
+  MAGIC = 'Colossal trace 1\n'
+  RECORD = struct.Struct('<BII')
+  MOVING = struct.Struct('<BIIIB')  # A MOVE record and its destination
+  NOTHING = 0xffffffff
+  SPACING = 4
+  (COMMAND, CHECKPOINT, NEW, MOVE, QTY, NAME, WRITE, APPEND, SET, REVERSE,
+   VISIT, FORGET, OUTPUT) = range(13)
+  FRESH = { 'location': None, 'items': EMPTY, 'load': 0, 'fraction': 0,
+            'orders': None, 'running': False }
+  KEPT = {}  # The slots of each class a NEW record has values for
+
+  def __init__(self, filename):
+    self.file = open(filename, 'wb')
+    self.file.write(self.MAGIC)
+    self.step = STATS['commands']
+    self.since = 0  # Bytes written out since the last checkpoint
+    self.parts = []  # Records not yet written out
+    self.append = self.parts.append
+    self.checkpoint()
+
+  def write(self, kind, number, data=''):
+    self.append(self.RECORD.pack(kind, number, len(data)) + data)
+
+  def flush(self):
+    data = ''.join(self.parts)
+    del self.parts[:]
+    self.file.write(data)
+    self.since += len(data)
+
+  def checkpoint(self):
+    world = cPickle.dumps(dict([(name, globals()[name])
+                                for name in World.BUILT]), 2)
+    self.write(self.CHECKPOINT, self.step, world)
+    self.flush()
+    self.numbers = dict([(thing, n) for (n, thing) in enumerate(everything())])
+    self.since = 0
+    self.weight = len(world) * self.SPACING
+
+  def number(self, thing):
+    if thing is None:
+      return self.NOTHING
+    n = self.numbers.get(thing)
+    if n is None:
+      n = self.numbers[thing] = len(self.numbers)
+      cls = type(thing)
+      if cls not in self.KEPT:
+        self.KEPT[cls] = [name for name in slots(cls)
+                          if name not in self.FRESH]
+      state = {}
+      for name in self.KEPT[cls]:
+        value = getattr(thing, name, state)
+        if value is not state:
+          state[name] = value
+      if 'stack' in state:
+        state['stack'] = []
+      self.write(self.NEW, n, self.encode((cls.__name__, state)))
+    return n
+
+  @staticmethod
+  def encode(value):
+    try:
+      return marshal.dumps(value)
+    except ValueError:
+      return cPickle.dumps(value, 2)
+
+  @staticmethod
+  def decode(data):
+    if data[:1] == '\x80':
+      return cPickle.loads(data)
+    return marshal.loads(data)
+
+  def command(self, subject, line):
+    if self.since > self.weight:
+      self.checkpoint()
+    self.step += 1
+    n = self.numbers.get(subject)
+    if n is None:
+      n = self.number(subject)
+    self.append(self.RECORD.pack(self.COMMAND, n, len(line)) + line)
+
+  def move(self, thing, dest, inside):
+    numbers = self.numbers
+    n, m = numbers.get(thing), numbers.get(dest)
+    if n is None:
+      n = self.number(thing)
+    if m is None:
+      m = self.number(dest)
+    self.append(self.MOVING.pack(self.MOVE, n, 5, m, inside))
+
+  def change(self, kind, thing, value=None):
+    n = self.numbers.get(thing)
+    if n is None:
+      n = self.number(thing)
+    self.write(kind, n, '' if value is None else self.encode(value))
+
+  def close(self):
+    self.flush()
+    self.file.close()
+
+def replay(filename, step=None):
+  # Puts the world back as it was after step commands of the run traced
+  # to filename, or at the end of it, starting from the last checkpoint
+  # before then. Output since the checkpoint is output again. Returns the
+  # player.
+  global TRACE
+  f = open(filename, 'rb')
+  if f.read(len(Trace.MAGIC)) != Trace.MAGIC:
+    raise ColossalError('%s is not a trace' % filename)
+  start = None
+  while True:
+    header = f.read(Trace.RECORD.size)
+    if len(header) < Trace.RECORD.size:
+      break
+    kind, n, size = Trace.RECORD.unpack(header)
+    if kind == Trace.CHECKPOINT:
+      if start is not None and step is not None and n > step:
+        break
+      start = f.tell() - len(header)
+    f.seek(size, 1)
+  if start is None:
+    raise ColossalError('%s has no checkpoint' % filename)
+
+  f.seek(start)
+  tracing, TRACE = TRACE, None
+  things = []
+  try:
+    while True:
+      header = f.read(Trace.RECORD.size)
+      if len(header) < Trace.RECORD.size:
+        break
+      kind, n, size = Trace.RECORD.unpack(header)
+      data = f.read(size)
+      if len(data) < size:
+        break
+      if kind == Trace.COMMAND:
+        if step is not None and STATS['commands'] >= step:
+          break
+        STATS['commands'] += 1
+      elif kind == Trace.CHECKPOINT:
+        if things:
+          things = list(everything())
+          continue
+        globals().update(cPickle.loads(data))
+        things = list(everything())
+        for thing in things:
+          if isinstance(thing, Entity):
+            del thing.stack[:]
+            thing.running = False
+      elif kind == Trace.MOVE:
+        dest, inside = struct.unpack('<IB', data)
+        things[n].place(None if dest == Trace.NOTHING else things[dest],
+                        inside)
+      elif kind == Trace.NEW:
+        cls, state = Trace.decode(data)
+        cls = globals()[cls]
+        thing = cls.__new__(cls)
+        for name in slots(cls):
+          if name in Trace.FRESH:
+            setattr(thing, name, Trace.FRESH[name])
+        for name, value in state.items():
+          setattr(thing, name, value)
+        things.append(thing)
+        if isinstance(thing, Room):
+          ROOMS[thing.name] = thing
+          for direction in thing.exits:
+            learn(DIRECTIONS, direction)
+        else:
+          STATS['items'] += 1
+          learn(NOUNS, thing.noun.lower())
+          if thing.adjective:
+            learn(ADJECTIVES, thing.adjective.lower())
+          if thing.name:
+            learn(NAMES, thing.name.lower())
+      elif kind == Trace.REVERSE:
+        things[n].items.reverse()
+      else:
+        value = Trace.decode(data)
+        if kind == Trace.QTY:
+          things[n].qty = value
+        elif kind == Trace.NAME:
+          things[n].name = value
+        elif kind == Trace.WRITE:
+          things[n].writing = value
+        elif kind == Trace.APPEND:
+          things[n].append(value)
+        elif kind == Trace.SET:
+          setattr(things[n], *value)
+        elif kind == Trace.VISIT:
+          things[n].visited.add(value)
+        elif kind == Trace.FORGET:
+          ROOMS.pop(value, None)
+        elif kind == Trace.OUTPUT:
+          output(value)
+  finally:
+    TRACE = tracing
+    f.close()
+  del CHANGED[:]
+  for thing in everything():
+    if isinstance(thing, Player):
+      return thing
+  raise ColossalError('%s has no player' % filename)
+
+class Checkpoint(object):
+  # Saves all it takes to carry on with a run to filename, every commands
+  # commands or seconds seconds, whichever comes first. It's written
+  # afresh and renamed over the last, so there's always a whole one.
+  KEPT = [name for name in World.STATE
+          if name not in World.SETTINGS + ['TRACE', 'CHECKPOINT', 'FEEDBACK',
+                                           'OUTPUT', 'FILES', 'FETCHED']]
+
+  def __init__(self, filename, player, commands=None, seconds=60):
+    self.filename = filename
+    self.player = player
+    self.commands = commands
+    self.seconds = seconds
+    self.lines = None  # The input being followed, if it's from files
+    self.reset()
+
+  def reset(self):
+    self.step = self.commands and STATS['commands'] + self.commands
+    self.time = self.seconds and time.time() + self.seconds
+
+  def tick(self):
+    if ((self.step and STATS['commands'] >= self.step) or
+        (self.time and time.time() >= self.time)):
+      self.save()
+
+  def save(self):
+    state = dict([(name, globals()[name]) for name in self.KEPT])
+    state.update(player=self.player, random=random.getstate(),
+                 line=self.lines.lineno() if self.lines else 0,
+                 output=OUTPUT.tell() if isinstance(OUTPUT, Sink) else None)
+    temporary = self.filename + '.tmp'
+    try:
+      f = open(temporary, 'wb')
+      try:
+        cPickle.dump(state, f, 2)
+        f.flush()
+        os.fsync(f.fileno())
+      finally:
+        f.close()
+      os.rename(temporary, self.filename)
+    except:
+      try:
+        os.remove(temporary)
+      except OSError:
+        pass
+      raise
+    self.reset()
+
+def resume(filename):
+  # Puts everything back as it was checkpointed to filename; returns the
+  # player and how many lines of input they'd followed
+  f = open(filename, 'rb')
+  try:
+    state = cPickle.load(f)
+  finally:
+    f.close()
+  random.setstate(state.pop('random'))
+  if isinstance(OUTPUT, Sink):
+    OUTPUT.rewind(state.pop('output'))
+  player, line = state.pop('player'), state.pop('line')
+  globals().update(state)
+  return player, line
 
 
 ALIASES = {
@@ -1069,12 +2834,239 @@ ALIASES = {
 }
 
 
+def start(params):
+  # The player, with the parameters put where they belong
+  player = Player('Outside of a small house')
+  if params:
+    Item('letter', LANDMARKS['mailbox']).writing = params
+    for param in params:
+      bag = Item(random.choice(ORDINARY) + ' bag', LANDMARKS['cauldron'],
+                 capacity=float('inf'))
+      try:
+        q = quantity(param)
+        Item('dirt', bag).qty = q
+      except ValueError:
+        Item('pebble', bag)
+  return player
+
+
+class Timeout(ColossalError): pass
+
+def timeout(signum, frame):
+  raise Timeout('timed out')
+
+TIMEOUT = None  # Seconds a batch job may run
+
+def perform(job):
+  # Runs a batch job, a line of JSON, in a pristine world and returns its
+  # result. A line that isn't a job fails on its own.
+  import json
+  number, line = job
+  try:
+    job = json.loads(line)
+  except ValueError, e:
+    job = error = e
+  else:
+    error = line.strip()
+  if not isinstance(job, dict):
+    return dict(job=number, stdout='', status=1, commands=0, time=0.0,
+                error='Not a job: %s' % error)
+  result = dict(job, job=number, stdout='', status=0, error=None,
+                commands=0)
+  start_time = time.time()
+  session = lines = None
+  try:
+    if TIMEOUT:
+      signal.signal(signal.SIGALRM, timeout)
+      signal.setitimer(signal.ITIMER_REAL, TIMEOUT)
+    session = Session([str(param) for param in job.get('params', [])],
+                      FEEDBACK)
+    lines = fileinput.FileInput([str(job['script'])])
+    with session.world:
+      session.player.execute(lines)
+  except Timeout, e:
+    result.update(status=124, error=str(e))
+  except ColossalError, e:
+    result.update(status=1, error=str(e))
+  except Exception, e:
+    result.update(status=1, error='%s: %s' % (e.__class__.__name__, e))
+  finally:
+    if TIMEOUT:
+      signal.setitimer(signal.ITIMER_REAL, 0)
+    if lines:
+      lines.close()
+    if session:
+      result.update(stdout=session.stdout.getvalue(),
+                    commands=session.world.state['STATS']['commands'])
+    result.update(time=time.time() - start_time)
+  return result
+
+def batch(jobs, workers, ordered):
+  # Runs jobs, each a line of JSON, in a pool of workers forked from this
+  # process, so the world's already built; writes their results to stdout
+  import json, multiprocessing
+  jobs = enumerate(line for line in jobs if line.strip())
+  if workers == 1:
+    results = itertools.imap(perform, jobs)
+  else:
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+    if ordered:
+      results = pool.imap(perform, jobs)
+    else:
+      results = pool.imap_unordered(perform, jobs)
+  failed = False
+  for result in results:
+    sys.stdout.write(json.dumps(result) + '\n')
+    sys.stdout.flush()
+    failed = failed or result['status']
+  return failed
+
+
+SLICE = 100  # Commands a session may follow before the next one's turn
+BACKLOG = 1 << 16  # Bytes of unsent output at which a session is paused
+WAITING = 1000  # Lines told but not followed at which reading stops
+IDLE = 600  # Seconds without a word from a player before they're dropped
+
+class Connection(asyncore.dispatcher):
+  # A player at the other end of a socket, in a world of their own, where
+  # the pidgeon can't be sent for files on this host
+  def __init__(self, sock, server, address):
+    asyncore.dispatcher.__init__(self, sock)
+    self.server = server
+    self.address = address or 'unix socket'
+    self.session = Session(feedback=sys.stdout, files=False)
+    self.unsent = 'Welcome to Colossal!\n\n'
+    self.partial = ''
+    self.heard = time.time()
+    self.busy = False
+    server.connections.append(self)
+    self.send_output()
+
+  def readable(self):
+    return (len(self.session.pending) < WAITING and
+            len(self.unsent) < BACKLOG)
+
+  def writable(self):
+    return bool(self.unsent)
+
+  def handle_read(self):
+    data = self.recv(4096)
+    self.heard = time.time()
+    lines = (self.partial + data).split('\n')
+    self.partial = lines.pop()
+    for line in lines:
+      self.session.tell(line.rstrip('\r'))
+
+  def handle_write(self):
+    sent = self.send(self.unsent)
+    self.unsent = self.unsent[sent:]
+    if not self.unsent and not self.session.player.active:
+      self.handle_close()
+
+  def handle_close(self):
+    if self in self.server.connections:
+      self.server.connections.remove(self)
+      sys.stderr.write('colossal.py: %s left after %d commands, %.3fs run\n'
+                       % (self.address,
+                          self.session.world.state['STATS']['commands'],
+                          self.session.spent))
+    self.close()
+
+  def turn(self):
+    # Follows a slice of the player's commands, unless they're not keeping
+    # up with the output; returns whether there's more to follow
+    session = self.session
+    if len(self.unsent) >= BACKLOG or not (session.pending or self.busy):
+      return False
+    try:
+      self.busy = session.step(SLICE)
+    except ColossalError, e:
+      session.stdout.write('colossal.py: %s\n' % e)
+      self.busy = bool(session.pending)
+    except Exception, e:
+      # The world can't be trusted after that, so the player's told what
+      # went wrong and starts again in a new one. No one else is affected.
+      error = '%s: %s' % (e.__class__.__name__, e)
+      sys.stderr.write('colossal.py: %s: %s\n' % (self.address, error))
+      self.unsent += session.drain()
+      self.unsent += 'colossal.py: %s\nStarting over.\n\n' % error
+      self.session = Session(feedback=sys.stdout, files=False)
+      self.busy = False
+    self.send_output(not self.busy)
+    return self.busy
+
+  def send_output(self, prompt=True):
+    self.unsent += self.session.drain()
+    if prompt and self.session.player.active:
+      self.unsent += '\n> '
+
+
+class Server(asyncore.dispatcher):
+  # Takes players' connections at address, HOST:PORT or the path of a Unix
+  # socket, and gives each their turn in a world of their own
+  def __init__(self, address):
+    asyncore.dispatcher.__init__(self)
+    if ':' in address:
+      host, port = address.rsplit(':', 1)
+      self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+      address = (host, int(port))
+    else:
+      self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      if os.path.exists(address):
+        os.remove(address)
+    self.set_reuse_addr()
+    self.bind(address)
+    self.listen(64)
+    self.connections = []
+
+  def handle_accept(self):
+    accepted = self.accept()
+    if accepted:
+      Connection(accepted[0], self, accepted[1])
+
+  def serve(self):
+    while True:
+      busy = False
+      for connection in list(self.connections):
+        busy = connection.turn() or busy
+        if (not connection.busy and
+            time.time() - connection.heard > IDLE):
+          connection.handle_close()
+      asyncore.loop(0 if busy else 1, count=1)
+
+
+def terminate(signum, frame):
+  # Exits as if the run were over, so what's buffered is written out; or
+  # if a sink's writing out, has it exit once it's done
+  global TERMINATED
+  if WRITING:
+    TERMINATED = 128 + signum
+  else:
+    sys.exit(128 + signum)
+
 def main():
-  global FEEDBACK
-  opts,args = getopt.getopt(sys.argv[1:], 'vVqf:hi')
+  global FEEDBACK, MAX_DEPTH, PROFILE, TIMEOUT, PREFETCH, OUTPUT, TRACE
+  global CHECKPOINT
+  opts,args = getopt.getopt(sys.argv[1:],
+                            'vVqf:hid:sPF:b:j:t:uS:po:B:I:rT:R:n:c:e:',
+                            ['resume'])
   INTERACTIVE = None
+  STATISTICS = False
+  PROFILING = False
+  FLAMES = None
   FEEDBACK = None
   FILENAMES = []
+  BATCH = None
+  SERVE = None
+  WORKERS = None  # As many as there are CPUs
+  ORDERED = True
+  SINK = {}
+  TRACING = None
+  REPLAY = None
+  STEP = None
+  CHECKPOINTING = None
+  EVERY = {}
+  RESUME = False
   for o,a in opts:
     if o == '-v':
       FEEDBACK = sys.stderr
@@ -1086,33 +3078,112 @@ def main():
       FILENAMES.append(a)
     elif o == '-i':
       INTERACTIVE = True
+    elif o == '-d':
+      MAX_DEPTH = int(a)
+    elif o == '-s':
+      STATISTICS = True
+    elif o == '-P':
+      PROFILING = True
+    elif o == '-F':
+      FLAMES = a
+    elif o == '-b':
+      BATCH = a
+    elif o == '-j':
+      WORKERS = int(a)
+    elif o == '-t':
+      TIMEOUT = float(a)
+    elif o == '-u':
+      ORDERED = False
+    elif o == '-S':
+      SERVE = a
+    elif o == '-p':
+      PREFETCH = True
+    elif o == '-o':
+      SINK['fd'] = int(a)
+    elif o == '-B':
+      SINK['buffer'] = int(a)
+    elif o == '-I':
+      SINK['interval'] = float(a)
+    elif o == '-r':
+      SINK['raw'] = True
+    elif o == '-T':
+      TRACING = a
+    elif o == '-R':
+      REPLAY = a
+    elif o == '-n':
+      STEP = int(a)
+    elif o == '-c':
+      CHECKPOINTING = a
+    elif o == '-e':
+      if a.endswith('s'):
+        EVERY['seconds'] = float(a[:-1])
+      else:
+        EVERY.setdefault('seconds', None)
+        EVERY['commands'] = int(a)
+    elif o == '--resume':
+      RESUME = True
     else:
       sys.stderr.write(__doc__)
       sys.exit()
-  if FEEDBACK == None and not FILENAMES:
+  if FEEDBACK == None and not FILENAMES and not BATCH and not SERVE:
     FEEDBACK = sys.stderr
+  if SERVE:
+    Server(SERVE).serve()
+  if BATCH:
+    jobs = sys.stdin if BATCH == '-' else open(BATCH)
+    sys.exit(1 if batch(jobs, WORKERS, ORDERED) else 0)
+  if PROFILING or FLAMES:
+    PROFILE = Profile()
+  OUTPUT = Sink(**SINK)
+  signal.signal(signal.SIGTERM, terminate)
+  if FEEDBACK is sys.stdout and OUTPUT.fd == 1:
+    FEEDBACK = OUTPUT
+  elif FEEDBACK is sys.stderr:
+    FEEDBACK = Sink(2, OUTPUT.buffer, OUTPUT.interval)
 
   say('Welcome to Colossal!')
   say()
 
-  player = Player('Outside of a small house')
-  
-  if args:
-    Item('letter', mailbox).writing = args
-    for arg in args:
-      bag = Item(random.choice(ORDINARY) + ' bag', cauldron,
-                 capacity=float('inf'))
-      try:
-        q = float(arg)
-        Item('dirt', bag).qty = q
-      except ValueError:
-        Item('pebble', bag)
-        
-
-  if FILENAMES:
-    player.execute(fileinput.input(FILENAMES))
-  if INTERACTIVE or not FILENAMES:
-    player.execute()
+  try:
+    done = 0  # Lines of input followed before resuming
+    if REPLAY:
+      player = replay(REPLAY, STEP)
+    elif RESUME and CHECKPOINTING and os.path.exists(CHECKPOINTING):
+      player, done = resume(CHECKPOINTING)
+    else:
+      player = start(args)
+    if TRACING:
+      TRACE = Trace(TRACING)
+    if CHECKPOINTING:
+      CHECKPOINT = Checkpoint(CHECKPOINTING, player, **EVERY)
+    turns()
+    if FILENAMES:
+      lines = fileinput.input(FILENAMES)
+      for line in itertools.islice(lines, done):
+        pass
+      if CHECKPOINT:
+        CHECKPOINT.lines = lines
+      player.execute(lines)
+    if INTERACTIVE or not FILENAMES:
+      player.execute()
+  except ColossalError, e:
+    if FEEDBACK:
+      FEEDBACK.flush()
+    sys.stderr.write('colossal.py: ' + str(e) + '\n')
+    sys.exit(1)
+  finally:
+    OUTPUT.flush()
+    if FEEDBACK:
+      FEEDBACK.flush()
+    if TRACE:
+      TRACE.close()
+    if STATISTICS:
+      import json
+      sys.stderr.write(json.dumps(STATS) + '\n')
+    if PROFILING:
+      PROFILE.report(sys.stderr)
+    if FLAMES:
+      PROFILE.collapse(open(FLAMES, 'w'))
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,283 @@
+#! /usr/bin/python
+
+"""Regression tests for colossal.py. Run with: python test_colossal.py"""
+
+import sys, os, time, unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+os.chdir(HERE)
+
+import colossal
+
+
+class RunTest(unittest.TestCase):
+  def test_hello(self):
+    lines, stats = colossal.run(open('hello.adv'))
+    self.assertEqual(lines, ['Hello, World!'])
+
+  def test_gcd(self):
+    lines, stats = colossal.run(open('gcd.adv'), ['12', '18'])
+    self.assertEqual(lines, ['6'])
+
+  def test_empty_script(self):
+    # An empty script is followed, not taken to mean reading stdin
+    lines, stats = colossal.run([])
+    self.assertEqual(lines, [])
+    self.assertEqual(stats['commands'], 0)
+
+  def test_sessions_keep_their_worlds(self):
+    session = colossal.Session()
+    session.run(['e', 'take shovel'])
+    other = colossal.Session()
+    with session.world:
+      self.assertEqual([str(item) for item in session.player.items],
+                       ['shovel'])
+    with other.world:
+      self.assertEqual(list(other.player.items), [])
+
+  def test_orders_written_while_obeying_others(self):
+    # Orders that end by obeying others follow what those write on them
+    session = colossal.Session()
+    session.run(['e', 'e', 'ne', 'n', 'take pen from backpack'] + ['n'] * 5 +
+                ['w', 'take parchment from folder from cabinet', 'e', 's',
+                 'put parchment into shredder',
+                 'take first parchment from shredder', 'call last in me P',
+                 'take first parchment from shredder', 'call last in me Q',
+                 'write on P with pen "obey Q"',
+                 'write on Q with pen "write on P with pen \'drop pen\'"',
+                 'obey P'])
+    with session.world:
+      self.assertEqual(sorted(item.noun for item in session.player.items),
+                       ['parchment', 'parchment'])
+
+  def test_sessions_keep_their_settings(self):
+    # A world's set to run as the one it was made in was, and keeps to
+    # itself the files fetched in it
+    session = colossal.Session()
+    with session.world:
+      colossal.MAX_DEPTH = 5
+      inner = colossal.Session()
+    other = colossal.Session()
+    self.assertEqual(colossal.MAX_DEPTH, 10000)
+    self.assertEqual(session.world.state['MAX_DEPTH'], 5)
+    self.assertEqual(inner.world.state['MAX_DEPTH'], 5)
+    self.assertEqual(other.world.state['MAX_DEPTH'], 10000)
+    self.assertNotEqual(id(session.world.state['FETCHED']),
+                        id(other.world.state['FETCHED']))
+
+  def test_sessions_run_side_by_side(self):
+    # A session following orders forever in one thread doesn't keep
+    # another's from running in the meantime
+    import threading
+    looping = colossal.Session()
+    thread = threading.Thread(target=looping.run, args=(LATE.splitlines(),))
+    thread.daemon = True
+    thread.start()
+    try:
+      while not looping.world.state['STATS']['commands']:
+        time.sleep(0.01)
+      lines, stats = colossal.run(open('gcd.adv'), ['12', '18'])
+      self.assertEqual(lines, ['6'])
+      self.assertTrue(thread.is_alive())
+    finally:
+      looping.player.active = False
+      thread.join(10)
+    self.assertFalse(thread.is_alive())
+
+
+class WeightTest(unittest.TestCase):
+  def test_infinite_dirt_comes_and_goes(self):
+    # Taking infinite dirt out of a bag leaves it weighing nothing, not nan
+    session = colossal.Session(['inf', '2'])
+    session.run(['e', 'e', 'ne', 'n', 'n', 'n', 'e',
+                 'call first in cauldron A', 'call last in cauldron B',
+                 'take A', 'take dirt from A', 'put dirt into B',
+                 'take dirt from B', 'put dirt into A', 'drop A'])
+    with session.world:
+      player = session.player
+      a, = player.location.find(colossal.Itemspec(['A']))
+      b, = colossal.LANDMARKS['cauldron'].find(colossal.Itemspec(['B']))
+      self.assertEqual(player.load, 0)
+      self.assertEqual(a.weight(), float('inf'))
+      self.assertEqual(b.weight(), 0)
+
+
+  def test_heavier_with_fractions(self):
+    # The balance compares weights with fractions of a kilogram exactly
+    import fractions
+    session = colossal.Session()
+    with session.world:
+      half, third = fractions.Fraction(1, 2), fractions.Fraction(1, 3)
+      a, b = [colossal.Item('bag', None, capacity=float('inf'))
+              for i in range(2)]
+      colossal.Item('dirt', a).qty = 2 + half
+      colossal.Item('dirt', b).qty = 2
+      self.assertTrue(colossal.heavier(a, b))
+      self.assertFalse(colossal.heavier(b, a))
+      colossal.Item('dirt', b).qty = half
+      self.assertFalse(colossal.heavier(a, b))
+      self.assertFalse(colossal.heavier(b, a))
+      colossal.Item('dirt', b).qty = third
+      self.assertTrue(colossal.heavier(b, a))
+      self.assertEqual(b.weight(), 2 + half + third)
+
+
+class PrintoutTest(unittest.TestCase):
+  def test_long_printout_isnt_cached(self):
+    # Following a long printout doesn't keep what's parsed of every line
+    import tempfile
+    f = tempfile.NamedTemporaryFile(suffix='.adv')
+    for i in range(3 * colossal.CACHED):
+      f.write('think "%d" word%d\n' % (i, i))
+    f.flush()
+    session = colossal.Session()
+    with session.world:
+      printout = colossal.Item('printout', session.player)
+      printout.writing = colossal.fetch(f.name)
+    session.run(['obey printout'])
+    with session.world:
+      self.assertEqual(colossal.STATS['commands'], 3 * colossal.CACHED + 1)
+      self.assertEqual(printout.procedure().commands, {})
+      self.assertFalse('word0' in colossal.PARSED)
+
+
+LATE = """e
+e
+ne
+n
+get all from backpack
+erase page
+write on page with pen "Hello, World!"
+n
+n
+n
+n
+n
+e
+put page into drain
+w
+w
+open cabinet
+take parchment from folder in cabinet
+erase parchment
+write on parchment with pen "think busy;obey parchment in me"
+obey parchment
+"""
+
+class SinkTest(unittest.TestCase):
+  def late(self, *opts):
+    # Starts a run that outputs a line and then follows orders forever;
+    # returns it and the file its output's going to
+    import subprocess, tempfile
+    script = tempfile.NamedTemporaryFile(suffix='.adv')
+    script.write(LATE)
+    script.flush()
+    out = tempfile.TemporaryFile()
+    run = subprocess.Popen([sys.executable, 'colossal.py'] + list(opts) +
+                           ['-f', script.name], stdout=out)
+    run.script = script
+    return run, out
+
+  def read(self, out):
+    out.seek(0)
+    return out.read()
+
+  def test_interval_while_quiet(self):
+    # Output's written out every -I seconds even once the run's gone quiet
+    import time
+    run, out = self.late('-I', '0.1')
+    try:
+      for i in range(100):
+        if self.read(out):
+          break
+        time.sleep(0.05)
+      self.assertEqual(self.read(out), 'Hello, World!\n')
+    finally:
+      run.kill()
+      run.wait()
+
+  def test_terminated(self):
+    # What's buffered is written out when the run's terminated
+    import time
+    run, out = self.late()
+    time.sleep(1)
+    run.terminate()
+    self.assertEqual(run.wait(), 128 + 15)
+    self.assertEqual(self.read(out), 'Hello, World!\n')
+
+  def test_terminated_while_writing(self):
+    # A sink terminated part way through writing out finishes first
+    import tempfile
+    out = tempfile.TemporaryFile()
+    sink = colossal.Sink(out.fileno())
+    sink.write('Hello, ')
+    sink.write('World!\n')
+    write = os.write
+    def terminated(fd, data):
+      colossal.terminate(15, None)
+      return write(fd, data[:3])
+    os.write = terminated
+    try:
+      self.assertRaises(SystemExit, sink.flush)
+    finally:
+      os.write = write
+    self.assertEqual(self.read(out), 'Hello, World!\n')
+
+
+HOT = """e
+e
+ne
+n
+get all from backpack
+erase page
+write on page with pen "Hello, World!"
+n
+n
+%sn
+n
+n
+e
+put page into drain
+""" % ('tell robot "think hi"\n' * 60)
+
+class CheckpointTest(unittest.TestCase):
+  def test_resume_hot_speech(self):
+    # What the robot's made of a speech it's heard often enough to compile
+    # is checkpointed, and the run resumed, without it
+    import subprocess, tempfile
+    script = tempfile.NamedTemporaryFile(suffix='.adv')
+    script.write(HOT)
+    script.flush()
+    directory = tempfile.mkdtemp()
+    checkpoint = os.path.join(directory, 'hot.checkpoint')
+    out = os.path.join(directory, 'hot.out')
+    command = [sys.executable, 'colossal.py', '-c', checkpoint, '-e', '5',
+               '-f', script.name]
+    try:
+      for extra in [], ['--resume']:
+        with open(out, 'ab') as f:
+          self.assertEqual(subprocess.call(command + extra, stdout=f), 0)
+        self.assertEqual(open(out).read(), 'Hello, World!\n')
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['hot.checkpoint', 'hot.out'])
+    finally:
+      for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+      os.rmdir(directory)
+
+
+class BatchTest(unittest.TestCase):
+  def test_bad_line_fails_alone(self):
+    # A line that isn't a job fails without taking the batch down
+    for line in ['not json\n', '[1]\n']:
+      result = colossal.perform((0, line))
+      self.assertEqual(result['status'], 1)
+      self.assertTrue(result['error'].startswith('Not a job: '))
+    result = colossal.perform((1, '{"script": "hello.adv"}\n'))
+    self.assertEqual(result['status'], 0)
+    self.assertEqual(result['stdout'], 'Hello, World!\n')
+
+
+if __name__ == '__main__':
+  unittest.main()